@@ -1,15 +1,31 @@
+import argparse
+import csv
+import json
 import os
+import re
 import struct
 import sys
 import xlsxwriter
 
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from itertools import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "py"))
+
+import metrics
+
+from mm_files import ANI_FRAME, AniFile
+
 # File signatures
-SIGNATURE_ANI = "ANI\x00"
 SIGNATURE_EVT = "EVT\x00"
 SIGNATURE_MPS = "MPS\x00"
 
-# .ani
-FRAME_TYPE_SPRITE = 0
+# Record layouts
+EVT_HEADER   = struct.Struct("<4s3I")
+EVT_EVENT    = struct.Struct("<6I48s")
+MPS_HEADER   = struct.Struct("<4s3I")
+MPS_ELEMENT  = struct.Struct("<5I5i")
 
 # .mps
 MPS_ELEMENTS = (
@@ -140,13 +156,20 @@ COL_GREEN  = "#63BE7B"
 COL_YELLOW = "#FFEB84"
 COL_RED    = "#F8696B"
 
-def unpack(f, b):
-	return struct.unpack(f, b)[0]
+# Output formats
+FORMAT_XLSX  = "xlsx"
+FORMAT_CSV   = "csv"
+FORMAT_JSONL = "jsonl"
 
-def get_spreadsheet(sheet_path):
-	workbook  = xlsxwriter.Workbook(sheet_path)
-	worksheet = workbook.add_worksheet()
-	formats   = {
+SUPPORTED_TYPES = (
+	".ani",
+	".evt",
+	".mps",
+)
+
+def get_workbook(sheet_path, constant_memory = False):
+	workbook = xlsxwriter.Workbook(sheet_path, {"constant_memory": constant_memory})
+	formats  = {
 		"default": [
 			workbook.add_format({
 				"align"  : "left",
@@ -178,200 +201,174 @@ def get_spreadsheet(sheet_path):
 		}),
 	}
 
-	worksheet.set_zoom(120)
-
-	return (workbook, worksheet, formats,)
-
-def unpack_ani(file_path):
-	name, ext = os.path.splitext(file_path)
-
-	# Spreadsheet setup
-	sheet_path = f"{name}.xlsx"
-	workbook, worksheet, FORMATS = get_spreadsheet(sheet_path)
-
-	headers = (
-		"Offset",
-		"Anim No.",
-		"Frame No.",
-		"Frame Type",
-		"Frame Entry",
-		"U01",
-		"U02",
-		"U03",
-		"U04",
-		"U05",
-		"U06",
-		"U07",
-		"U08",
-		"U09",
-		"U10",
-		"U11",
-	)
-
-	row = 0
-	col = 0
-
-	# Add header row
-	for h in headers:
-		worksheet.write(row, col, h, FORMATS["bold"])
-		col += 1
+	return (workbook, formats,)
 
-	row += 1
+def add_worksheet(workbook, name = None):
+	worksheet = workbook.add_worksheet(name)
+	worksheet.set_zoom(120)
 
-	file_handle = open(file_path, mode = "rb")
+	return worksheet
 
-	signature = file_handle.read(4).decode()
+class XlsxSink:
+	"""
+	Writes rows to a spreadsheet, one write_row call per row. With constant_memory set, each row is flushed to
+	disk as soon as the next one is started, so memory use doesn't grow with the number of rows.
+	"""
+	def __init__(self, path, headers, constant_memory = False, workbook = None, sheet_name = None):
+		self.path    = path
+		self.headers = headers
+		self.row     = 1
 
-	if signature != SIGNATURE_ANI:
-		raise "Invalid signature"
+		# Sinks sharing a workbook each write to their own sheet; the workbook is closed by its owner
+		self.owner = workbook is None
 
-	file_size    = unpack("<I", file_handle.read(4))
-	frames_count = unpack("<I", file_handle.read(4))
-	version      = unpack("<I", file_handle.read(4))
-	unknown_1    = unpack("<I", file_handle.read(4))
-	anim_count   = unpack("<I", file_handle.read(4))
-	assoc_sprite = file_handle.read(20).decode().strip("\x00")
+		if self.owner:
+			workbook = get_workbook(path, constant_memory)
 
-	print("--------------------------------")
-	print(f"Reading file {file_path}")
-	print("--------------------------------")
-	print("File size    : ", file_size)
-	print("Total frames : ", frames_count)
-	print("Version      : ", version)
-	print("unknown_1    : ", unknown_1)
-	print("Total anims  : ", anim_count)
-	print("Anim sprite  : ", assoc_sprite)
-	print()
+		self.workbook, self.formats = workbook
+		self.worksheet = add_worksheet(self.workbook, sheet_name)
+		self.worksheet.write_row(0, 0, headers, self.formats["bold"])
 
-	frame_deltas = []
+	def write(self, values, last_in_group = False):
+		# Use formatting with bottom-border if this is the last row of a group
+		f = 1 if last_in_group else 0
 
-	for i in range(anim_count):
-		frame_deltas.append(unpack("<I", file_handle.read(4)))
+		for col, value in enumerate(values):
+			kind = "default" if isinstance(value, str) else "number"
+			self.worksheet.write(self.row, col, value, self.formats[kind][f])
 
-	for i in range(anim_count):
-		if i + 1 < anim_count:
-			anim_frame_count = frame_deltas[i+1] - frame_deltas[i]
+		self.row += 1
 
-			for j in range(anim_frame_count):
-				# Reset column
-				col = 0
+	def close(self, colour_scales = ()):
+		# Conditional formatting: low = green
+		for h in colour_scales:
+			i = self.headers.index(h)
 
-				# Use formatting with bottom-border if this is the last frame of this group
-				f = 1 if (j + 1 == anim_frame_count) else 0
+			self.worksheet.conditional_format(1, i, self.row - 1, i, {
+				"type"      : "3_color_scale",
+				"min_color" : COL_GREEN,
+				"mid_color" : COL_YELLOW,
+				"max_color" : COL_RED,
+			})
 
-				# File offset
-				worksheet.write(row, col, file_handle.tell(), FORMATS["number"][f])
-				col += 1
+		# Data filter
+		self.worksheet.autofilter(0, 0, self.row - 1, len(self.headers) - 1)
 
-				frame_type  = unpack("<I", file_handle.read(4))
-				frame_entry = unpack("<i", file_handle.read(4))
-				data1       = unpack("<i", file_handle.read(4))
-				data2       = unpack("<i", file_handle.read(4))
+		# Freeze from C2
+		self.worksheet.freeze_panes(1, 2)
 
-				if frame_type == FRAME_TYPE_SPRITE:
-					data3 = file_handle.read(8).decode().strip("\x00")
-				else:
-					temp_1 = unpack("<i", file_handle.read(4))
-					temp_2 = unpack("<i", file_handle.read(4))
+		if self.owner:
+			self.workbook.close()
 
-					if temp_1 == 0 and temp_2 == 0:
-						data3 = ""
-					else:
-						data3 = str(temp_1) + " " + str(temp_2)
+class CsvSink:
+	def __init__(self, path, headers):
+		self.path   = path
+		self.handle = open(path, mode = "w", newline = "", encoding = "utf-8")
+		self.writer = csv.writer(self.handle)
+		self.writer.writerow(headers)
 
-				data4  = unpack("<b", file_handle.read(1))
-				data5  = unpack("<b", file_handle.read(1))
-				data6  = unpack("<b", file_handle.read(1))
-				data7  = unpack("<b", file_handle.read(1))
-				data8  = unpack("<i", file_handle.read(4))
-				data9  = unpack("<i", file_handle.read(4))
-				data10 = unpack("<i", file_handle.read(4))
-				data11 = unpack("<i", file_handle.read(4))
+	def write(self, values, last_in_group = False):
+		self.writer.writerow(values)
 
-				# Group no.
-				worksheet.write(row, col, i + 1, FORMATS["number"][f])
-				col += 1
+	def close(self, colour_scales = ()):
+		self.handle.close()
 
-				# Frame no.
-				worksheet.write(row, col, j + 1, FORMATS["number"][f])
-				col += 1
+class JsonlSink:
+	def __init__(self, path, headers):
+		self.path    = path
+		self.headers = headers
+		self.handle  = open(path, mode = "w", encoding = "utf-8")
 
-				worksheet.write(row, col, frame_type, FORMATS["number"][f])
-				col += 1
+	def write(self, values, last_in_group = False):
+		self.handle.write(json.dumps(dict(zip(self.headers, values))) + "\n")
 
-				worksheet.write(row, col, frame_entry, FORMATS["number"][f])
-				col += 1
+	def close(self, colour_scales = ()):
+		self.handle.close()
 
-				worksheet.write(row, col, data1, FORMATS["number"][f])
-				col += 1
+def get_sink(output_name, headers, output_format, constant_memory = False):
+	path = f"{output_name}.{output_format}"
 
-				worksheet.write(row, col, data2, FORMATS["number"][f])
-				col += 1
+	if output_format == FORMAT_CSV:
+		return CsvSink(path, headers)
 
-				worksheet.write(row, col, data3, FORMATS["default"][f])
-				col += 1
+	if output_format == FORMAT_JSONL:
+		return JsonlSink(path, headers)
 
-				worksheet.write(row, col, data4, FORMATS["number"][f])
-				col += 1
+	return XlsxSink(path, headers, constant_memory)
 
-				worksheet.write(row, col, data5, FORMATS["number"][f])
-				col += 1
+def read_signature(data, signature):
+	if data[:4].decode(errors = "replace") != signature:
+		raise ValueError(f"Invalid signature (expected {signature!r})")
 
-				worksheet.write(row, col, data6, FORMATS["number"][f])
-				col += 1
+def print_info(file_path, info):
+	width = max(len(k) for k in info)
 
-				worksheet.write(row, col, data7, FORMATS["number"][f])
-				col += 1
-
-				worksheet.write(row, col, data8, FORMATS["number"][f])
-				col += 1
-
-				worksheet.write(row, col, data9, FORMATS["number"][f])
-				col += 1
-
-				worksheet.write(row, col, data10, FORMATS["number"][f])
-				col += 1
-
-				worksheet.write(row, col, data11, FORMATS["number"][f])
-				col += 1
+	print("--------------------------------")
+	print(f"Reading file {file_path}")
+	print("--------------------------------")
 
-				row += 1
-		else:
-			break
-			raise "To-do: read last frame"
+	for k, v in info.items():
+		print(f"{k:<{width}} : ", v)
 
-	# Conditional formatting: low = green
-	for h in ("Frame Type",):
-		i = headers.index(h)
+	print()
 
-		worksheet.conditional_format(1, i, row, i, {
-			"type"      : "3_color_scale",
-			"min_color" : COL_GREEN,
-			"mid_color" : COL_YELLOW,
-			"max_color" : COL_RED,
-		})
+def read_ani(file_path):
+	"""
+	Returns the column headers, header values, and a generator of (row, last_in_group) tuples.
+	"""
+	headers = (
+		"Offset",
+		"Anim No.",
+		"Frame No.",
+		"Frame Type",
+		"Frame Entry",
+		"U01",
+		"U02",
+		"U03",
+		"U04",
+		"U05",
+		"U06",
+		"U07",
+		"U08",
+		"U09",
+		"U10",
+		"U11",
+	)
 
-	file_handle.close()
+	ani = AniFile(file_path)
 
-	# Data filter
-	worksheet.autofilter(0, 0, row, len(headers) - 1)
+	info = {
+		"File size"    : len(ani.buffer),
+		"Total frames" : ani.frame_count,
+		"Version"      : ani.version,
+		"unknown_1"    : ani.unknown,
+		"Total anims"  : ani.animation_count,
+		"Anim sprite"  : ani.sprite_file,
+	}
 
-	# Freeze from C2
-	worksheet.freeze_panes(1, 2)
+	def rows():
+		for i in range(ani.animation_count):
+			# The last group runs to the end of the frame table
+			start, end = ani.animation_range(i)
+			frames     = ani.frames[start:end]
 
-	print(f"Saving data to file {sheet_path}\n")
+			for j, frame in enumerate(frames):
+				offset = ani.frames_offset + (start + j) * ANI_FRAME.size
 
-	workbook.close()
+				if frame.is_sprite:
+					data3 = frame.name
+				elif frame.values == (0, 0):
+					data3 = ""
+				else:
+					data3 = " ".join(map(str, frame.values))
 
-	print("Done\n")
+				row = [offset, i + 1, j + 1, frame.frame_type, frame.frame_data, frame.unknown_1, frame.unknown_2, data3, *frame[5:]]
 
-def unpack_evt(file_path):
-	name, ext = os.path.splitext(file_path)
+				yield (row, j + 1 == len(frames))
 
-	# Spreadsheet setup
-	sheet_path = f"{name}_evt.xlsx"
-	workbook, worksheet, FORMATS = get_spreadsheet(sheet_path)
+	return (headers, info, rows())
 
+def read_evt(file_path):
 	headers = (
 		"Offset",
 		"Event No.",
@@ -384,96 +381,33 @@ def unpack_evt(file_path):
 		"Event Name",
 	)
 
-	row = 0
-	col = 0
-
-	for h in headers:
-		worksheet.write(row, col, h, FORMATS["bold"])
-		col += 1
-
-	row += 1
-
-	file_handle = open(file_path, mode = "rb")
-
-	signature = file_handle.read(4).decode()
-
-	if signature != SIGNATURE_EVT:
-		raise "Invalid signature"
-
-	unknown_1   = unpack("<I", file_handle.read(4))
-	version     = unpack("<I", file_handle.read(4))
-	event_count = unpack("<I", file_handle.read(4))
-
-	print("--------------------------------")
-	print(f"Reading file {file_path}")
-	print("--------------------------------")
-	print("unknown_1    : ", unknown_1)
-	print("Version      : ", version)
-	print("Total events : ", event_count)
-	print()
-
-	for i in range(event_count):
-		col = 0
-
-		worksheet.write(row, col, file_handle.tell(), FORMATS["number"][0])
-		col += 1
-
-		worksheet.write(row, col, i + 1, FORMATS["number"][0])
-		col += 1
-
-		# Event values
-		x1 = unpack("<I", file_handle.read(4))
-		y1 = unpack("<I", file_handle.read(4))
-		z1 = unpack("<I", file_handle.read(4))
-		x2 = unpack("<I", file_handle.read(4))
-		y2 = unpack("<I", file_handle.read(4))
-		z2 = unpack("<I", file_handle.read(4))
-		event_name = file_handle.read(48).decode().strip("\x00")
-
-		worksheet.write(row, col, x1, FORMATS["number"][0])
-		col += 1
-
-		worksheet.write(row, col, y1, FORMATS["number"][0])
-		col += 1
-
-		worksheet.write(row, col, z1, FORMATS["number"][0])
-		col += 1
-
-		worksheet.write(row, col, x2, FORMATS["number"][0])
-		col += 1
-
-		worksheet.write(row, col, y2, FORMATS["number"][0])
-		col += 1
-
-		worksheet.write(row, col, z2, FORMATS["number"][0])
-		col += 1
-
-		worksheet.write(row, col, event_name, FORMATS["default"][0])
-		col += 1
+	with open(file_path, mode = "rb") as file_handle:
+		data = file_handle.read()
 
-		row += 1
+	read_signature(data, SIGNATURE_EVT)
 
-	file_handle.close()
+	_, unknown_1, version, event_count = EVT_HEADER.unpack_from(data)
 
-	# Data filter
-	worksheet.autofilter(0, 0, row, len(headers) - 1)
-
-	# Freeze from C2
-	worksheet.freeze_panes(1, 2)
+	info = {
+		"unknown_1"    : unknown_1,
+		"Version"      : version,
+		"Total events" : event_count,
+	}
 
-	print(f"Saving data to file {sheet_path}\n")
+	start = EVT_HEADER.size
+	event_count = min(event_count, (len(data) - start) // EVT_EVENT.size)
 
-	workbook.close()
+	def rows():
+		events = EVT_EVENT.iter_unpack(data[start:start + event_count * EVT_EVENT.size])
 
-	print("Done\n")
+		for i, (*location, event_name) in enumerate(events):
+			event_name = event_name.decode(errors = "replace").strip("\x00")
 
-def unpack_mps(file_path):
-	name, ext = os.path.splitext(file_path)
+			yield ([start + i * EVT_EVENT.size, i + 1, *location, event_name], False)
 
-	# Spreadsheet setup
-	sheet_path = f"{name}_mps.xlsx"
-	workbook, worksheet, FORMATS = get_spreadsheet(sheet_path)
+	return (headers, info, rows())
 
+def read_mps(file_path):
 	headers = (
 		"Offset",
 		"El No.",
@@ -489,153 +423,272 @@ def unpack_mps(file_path):
 		"U5",
 	)
 
-	row = 0
-	col = 0
+	with open(file_path, mode = "rb") as file_handle:
+		data = file_handle.read()
 
-	for h in headers:
-		worksheet.write(row, col, h, FORMATS["bold"])
-		col += 1
+	read_signature(data, SIGNATURE_MPS)
 
-	row += 1
+	_, unknown_1, version, elements = MPS_HEADER.unpack_from(data)
 
-	file_handle = open(file_path, mode = "rb")
+	info = {
+		"unknown_1"      : unknown_1,
+		"Version"        : version,
+		"Total elements" : elements,
+	}
 
-	signature = file_handle.read(4).decode()
+	start = MPS_HEADER.size
+	elements = min(elements, (len(data) - start) // MPS_ELEMENT.size)
 
-	if signature != SIGNATURE_MPS:
-		raise "Invalid signature"
+	def rows():
+		records = MPS_ELEMENT.iter_unpack(data[start:start + elements * MPS_ELEMENT.size])
 
-	unknown_1 = unpack("<I", file_handle.read(4))
-	version   = unpack("<I", file_handle.read(4))
-	elements  = unpack("<I", file_handle.read(4))
+		for i, (x, y, z, el_type, el_index, *values) in enumerate(records):
+			# MPS element type
+			if el_type < len(MPS_ELEMENTS):
+				type_name = MPS_ELEMENTS[el_type]
+			else:
+				type_name = f"{el_type} (Invalid)"
 
-	print("--------------------------------")
-	print(f"Reading file {file_path}")
-	print("--------------------------------")
-	print("unknown_1      : ", unknown_1)
-	print("Version        : ", version)
-	print("Total elements : ", elements)
-	print()
+			# Object name
+			if el_type == MPS_ARTIFACT and el_index < len(MM_OBJECTS):
+				el_name = MM_OBJECTS[el_index]
 
-	for i in range(elements):
-		col = 0
+			elif el_type == MPS_CREATURE and el_index < len(MM_CREATURES):
+				el_name = MM_CREATURES[el_index]
 
-		worksheet.write(row, col, file_handle.tell(), FORMATS["number"][0])
-		col += 1
+			else:
+				el_name = el_index
 
-		worksheet.write(row, col, i + 1, FORMATS["number"][0])
-		col += 1
+			yield ([start + i * MPS_ELEMENT.size, i + 1, x, y, z, type_name, el_name, *values], False)
 
-		x        = unpack("<I", file_handle.read(4))
-		y        = unpack("<I", file_handle.read(4))
-		z        = unpack("<I", file_handle.read(4))
-		el_type  = unpack("<I", file_handle.read(4))
-		el_index = unpack("<I", file_handle.read(4))
-		u1       = unpack("<i", file_handle.read(4))
-		u2       = unpack("<i", file_handle.read(4))
-		u3       = unpack("<i", file_handle.read(4))
-		u4       = unpack("<i", file_handle.read(4))
-		u5       = unpack("<i", file_handle.read(4))
+	return (headers, info, rows())
 
-		worksheet.write(row, col, x, FORMATS["number"][0])
-		col += 1
+READERS = {
+	".ani": (read_ani, "", ("Frame Type",)),
+	".evt": (read_evt, "_evt", ()),
+	".mps": (read_mps, "_mps", ()),
+}
 
-		worksheet.write(row, col, y, FORMATS["number"][0])
-		col += 1
+def read_file(reader, file_path):
+	"""
+	Runs a reader, timing it as "read" and counting the file's size in bytes_read.
+	"""
+	with metrics.timer("read"):
+		result = reader(file_path)
 
-		worksheet.write(row, col, z, FORMATS["number"][0])
-		col += 1
+	metrics.count("bytes_read", os.path.getsize(file_path))
 
-		# MPS element type
-		try:
-			worksheet.write(row, col, MPS_ELEMENTS[el_type], FORMATS["default"][0])
-			col += 1
-		except:
-			worksheet.write(row, col, f"{el_type} (Invalid)", FORMATS["default"][0])
-			col += 1
+	return result
 
-		# Object name
-		if el_type == MPS_ARTIFACT and el_index < len(MM_OBJECTS):
-			worksheet.write(row, col, MM_OBJECTS[el_index], FORMATS["default"][0])
-			col += 1
+def unpack_file(file_path, output_format = FORMAT_XLSX, constant_memory = False, verbose = True):
+	name, ext = os.path.splitext(file_path)
+	reader, suffix, colour_scales = READERS[ext.lower()]
 
-		elif el_type == MPS_CREATURE and el_index < len(MM_CREATURES):
-			worksheet.write(row, col, MM_CREATURES[el_index], FORMATS["default"][0])
-			col += 1
+	with metrics.source(file_path):
+		headers, info, rows = read_file(reader, file_path)
 
-		else:
-			worksheet.write(row, col, el_index, FORMATS["number"][0])
-			col += 1
+		if verbose:
+			print_info(file_path, info)
 
-		worksheet.write(row, col, u1, FORMATS["number"][0])
-		col += 1
+		sink = get_sink(f"{name}{suffix}", headers, output_format, constant_memory)
 
-		worksheet.write(row, col, u2, FORMATS["number"][0])
-		col += 1
+		# Rows are decoded as they're written
+		with metrics.timer("write_rows"):
+			for row, last_in_group in rows:
+				sink.write(row, last_in_group)
+				metrics.count("rows")
 
-		worksheet.write(row, col, u3, FORMATS["number"][0])
-		col += 1
+		if verbose:
+			print(f"Saving data to file {sink.path}\n")
 
-		worksheet.write(row, col, u4, FORMATS["number"][0])
-		col += 1
+		with metrics.timer("save"):
+			sink.close(colour_scales)
 
-		worksheet.write(row, col, u5, FORMATS["number"][0])
-		col += 1
+	if verbose:
+		print("Done\n")
 
-		row += 1
+def convert_file(file_path, output_format, constant_memory):
+	"""
+	Process pool task; returns None on success, or the error.
+	"""
+	try:
+		unpack_file(file_path, output_format, constant_memory, verbose = False)
+	except Exception as e:
+		return repr(e)
 
-	file_handle.close()
+def decode_file(file_path):
+	"""
+	Process pool task for merged output; returns the headers and all rows, or the error.
+	"""
+	name, ext = os.path.splitext(file_path)
+	reader    = READERS[ext.lower()][0]
 
-	# Data filter
-	worksheet.autofilter(0, 0, row, len(headers) - 1)
+	try:
+		with metrics.source(file_path):
+			headers, info, rows = read_file(reader, file_path)
 
-	# Freeze from C2
-	worksheet.freeze_panes(1, 2)
+			with metrics.timer("decode_rows"):
+				rows = list(rows)
 
-	print(f"Saving data to file {sheet_path}\n")
+			metrics.count("rows", len(rows))
 
-	workbook.close()
+		return (headers, rows, None)
+	except Exception as e:
+		return (None, None, repr(e))
 
-	print("Done\n")
+def expand_inputs(inputs):
+	"""
+	Expands directories (recursively) and glob patterns into a sorted list of supported files.
+	"""
+	found = []
 
-def main():
-	supported_types = [
-		".ani",
-		".evt",
-		".mps",
-	]
+	for input_path in inputs:
+		if os.path.isdir(input_path):
+			for root, dirs, files in os.walk(input_path):
+				found.extend(os.path.join(root, f) for f in files if os.path.splitext(f)[1].lower() in SUPPORTED_TYPES)
 
-	if len(sys.argv) < 2:
-		print(f"Usage: {os.path.basename(sys.argv[0])} <file 1[, file 2, ...]>")
-		print("Supported file types:")
-		print("\n".join(supported_types))
-		exit()
+		elif re.search(r"[*?[]", input_path):
+			found.extend(p for p in glob(input_path) if os.path.splitext(p)[1].lower() in SUPPORTED_TYPES)
+
+		else:
+			found.append(input_path)
+
+	return sorted(set(found))
+
+def sheet_name_for(file_path, used):
+	# Excel sheet names are limited to 31 characters, and can't contain []:*?/\
+	base = re.sub(r"[\[\]:*?/\\]", "_", os.path.basename(file_path))[:31]
+	name = base
+	i    = 2
+
+	while name.lower() in used:
+		suffix = f"~{i}"
+		name   = base[:31 - len(suffix)] + suffix
+		i     += 1
+
+	used.add(name.lower())
+
+	return name
+
+def run_tasks(executor, func, *iterables):
+	"""
+	executor.map, except that when profiling each worker's metrics are merged into this process's.
+	"""
+	collector = metrics.get()
+
+	if collector is None:
+		yield from executor.map(func, *iterables)
+		return
+
+	for result, snapshot in executor.map(metrics.profiled, repeat(func), *iterables):
+		collector.merge(snapshot)
+		yield result
+
+def merge_files(file_paths, merge_path, merge_by, constant_memory, jobs):
+	"""
+	Writes every file into one workbook: a sheet per file, or (merge_by == "column") a sheet per file type with a
+	leading Source column. Returns a dict of file path to None or the error.
+	"""
+	results  = {}
+	workbook = get_workbook(merge_path, constant_memory)
+	sinks    = {}
+	used     = set()
+
+	with ProcessPoolExecutor(max_workers = jobs) as executor:
+		for file_path, (headers, rows, error) in zip(file_paths, run_tasks(executor, decode_file, file_paths)):
+			results[file_path] = error
+
+			if error is not None:
+				continue
 
-	done = 0
+			ext           = os.path.splitext(file_path)[1].lower()
+			colour_scales = READERS[ext][2]
 
-	for file_path in sys.argv[1:]:
+			with metrics.timer("write_rows"):
+				if merge_by == "column":
+					if ext not in sinks:
+						sinks[ext] = XlsxSink(merge_path, ["Source", *headers], workbook = workbook, sheet_name = ext[1:])
+
+					for row, last_in_group in rows:
+						sinks[ext].write([file_path, *row], last_in_group)
+				else:
+					sink = XlsxSink(merge_path, headers, workbook = workbook, sheet_name = sheet_name_for(file_path, used))
+
+					for row, last_in_group in rows:
+						sink.write(row, last_in_group)
+
+					sink.close(colour_scales)
+
+	with metrics.timer("save"):
+		for ext, sink in sinks.items():
+			sink.close(READERS[ext][2])
+
+		workbook[0].close()
+
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(epilog = "Supported file types: " + ", ".join(SUPPORTED_TYPES))
+	parser.add_argument("files", nargs = "+", help = "files, directories or glob patterns to convert")
+	parser.add_argument("-f", "--format", choices = (FORMAT_XLSX, FORMAT_CSV, FORMAT_JSONL), default = FORMAT_XLSX, help = "output format (default: xlsx)")
+	parser.add_argument("--stream", action = "store_true", help = "write spreadsheets in constant memory mode")
+	parser.add_argument("-j", "--jobs", type = int, default = 1, help = "number of worker processes (default: 1)")
+	parser.add_argument("--merge", metavar = "PATH", help = "write every file into one combined workbook")
+	parser.add_argument("--merge-by", choices = ("sheet", "column"), default = "sheet", help = "one sheet per file, or one sheet per file type with a Source column (default: sheet)")
+	parser.add_argument("--profile", metavar = "PATH", help = "save per-stage timings and counters, with percentiles, to a JSON file")
+	args = parser.parse_args()
+
+	if args.merge and args.format != FORMAT_XLSX:
+		parser.error("--merge is only supported for xlsx output")
+
+	collector  = metrics.enable() if args.profile else None
+	file_paths = []
+
+	for file_path in expand_inputs(args.files):
 		if not os.path.exists(file_path):
 			print(f"File not found: {file_path}")
 		else:
 			name, ext = os.path.splitext(file_path)
 			ext = ext.lower()
 
-			if ext not in supported_types:
+			if ext not in SUPPORTED_TYPES:
 				print(f"Unsupported file extension: {ext}")
 				continue
 
-			if ext == ".ani":
-				unpack_ani(file_path)
+			file_paths.append(file_path)
+
+	if args.merge:
+		results = merge_files(file_paths, args.merge, args.merge_by, args.stream, args.jobs)
+
+	elif args.jobs == 1:
+		results = {}
+
+		for file_path in file_paths:
+			try:
+				unpack_file(file_path, args.format, args.stream)
+				results[file_path] = None
+			except Exception as e:
+				results[file_path] = repr(e)
+
+	else:
+		with ProcessPoolExecutor(max_workers = args.jobs) as executor:
+			errors  = run_tasks(executor, convert_file, file_paths, repeat(args.format), repeat(args.stream))
+			results = dict(zip(file_paths, errors))
+
+	failed = {file_path: error for file_path, error in results.items() if error is not None}
+	done   = len(results) - len(failed)
 
-			elif ext == ".evt":
-				unpack_evt(file_path)
+	for file_path, error in failed.items():
+		print(f"Failed: {file_path}: {error}")
 
-			elif ext == ".mps":
-				unpack_mps(file_path)
+	print(f"Finished (processed {done} {'file' if done == 1 else 'files'}, {len(failed)} failed)")
 
-			done += 1
+	if collector is not None:
+		collector.save(args.profile)
+		print(f"Saved metrics to {args.profile}")
 
-	print(f"Finished (processed {done} {'file' if done == 1 else 'files'})")
+	if failed:
+		sys.exit(1)
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	main()
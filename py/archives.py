@@ -0,0 +1,173 @@
+"""
+Reads files straight out of zip and tar archives, addressed as `<archive>::<member>`:
+
+    assets.zip::Creatures/RedCap.spr
+    assets.tar.gz::Creatures/*.spr
+
+Members are read into memory, never extracted. Archive handles are kept open in a per-process pool, so reading
+many members of the same archive only opens (and indexes) it once. Random access into compressed tar archives
+(.tar.gz etc.) means decompressing from the start, so uncompressed tar or zip archives are much quicker.
+"""
+
+import os
+import tarfile
+import threading
+import zipfile
+
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from glob import glob
+
+
+SEPARATOR = "::"
+
+DEFAULT_MAX_OPEN = 8
+
+# Raised for missing, unreadable, non-archive or corrupt archives
+ERRORS = (OSError, ValueError, tarfile.TarError, zipfile.BadZipFile)
+
+
+def split_path(path: str):
+    """
+    Splits an archive path into (archive, member); plain paths return (None, path).
+    """
+    if SEPARATOR not in path:
+        return None, path
+
+    archive, member = path.split(SEPARATOR, 1)
+    return archive, member.replace("\\", "/").lstrip("/")
+
+
+def is_archive_path(path: str):
+    return split_path(path)[0] is not None
+
+
+class Archive:
+    """
+    A zip or tar archive opened for reading.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        if zipfile.is_zipfile(path):
+            self.handle = zipfile.ZipFile(path)
+            self.members = {info.filename: info for info in self.handle.infolist() if not info.is_dir()}
+        elif tarfile.is_tarfile(path):
+            self.handle = tarfile.open(path)
+            self.members = {info.name: info for info in self.handle.getmembers() if info.isfile()}
+        else:
+            raise ValueError(f"{path} isn't a zip or tar archive")
+
+    def names(self):
+        return list(self.members)
+
+    def match(self, pattern: str):
+        """
+        Member names matching a glob pattern, case-insensitively (as on Windows, where the game runs).
+        """
+        pattern = pattern.lower()
+        return sorted(name for name in self.members if fnmatchcase(name.lower(), pattern))
+
+    def read(self, name: str):
+        if name not in self.members:
+            raise FileNotFoundError(f"{name} not found in {self.path}")
+
+        if isinstance(self.handle, zipfile.ZipFile):
+            return self.handle.read(self.members[name])
+
+        return self.handle.extractfile(self.members[name]).read()
+
+    def close(self):
+        self.handle.close()
+
+
+class ArchivePool:
+    """
+    Keeps up to `max_open` archives open, closing the least recently used first. Safe to share between threads.
+    """
+
+    def __init__(self, max_open: int = DEFAULT_MAX_OPEN):
+        self.max_open = max_open
+        self.archives = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path: str):
+        key = os.path.realpath(path)
+
+        with self.lock:
+            if key in self.archives:
+                self.archives.move_to_end(key)
+                return self.archives[key]
+
+            archive = self.archives[key] = Archive(path)
+
+            while len(self.archives) > self.max_open:
+                _, evicted = self.archives.popitem(last=False)
+                evicted.close()
+
+            return archive
+
+    def close(self):
+        with self.lock:
+            for archive in self.archives.values():
+                archive.close()
+
+            self.archives.clear()
+
+    def forget(self):
+        """
+        Drops every handle without closing it; a forked child mustn't share its parent's file positions.
+        """
+        self.archives = OrderedDict()
+        self.lock = threading.Lock()
+
+
+pool = ArchivePool()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=pool.forget)
+
+
+def read_member(path: str):
+    """
+    Returns the bytes of an `<archive>::<member>` path.
+    """
+    archive, member = split_path(path)
+    return pool.get(archive).read(member)
+
+
+def member_identity(path: str):
+    """
+    Identifies an archive member; changes whenever the archive is modified or replaced.
+    """
+    archive, member = split_path(path)
+    stat = os.stat(archive)
+
+    return (os.path.realpath(archive), stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size, member)
+
+
+def expand(pattern: str):
+    """
+    Expands a filesystem glob, or an `<archive>::<member glob>` path (the archive part may also be a glob),
+    into a sorted list of paths.
+    """
+    archive_pattern, member_pattern = split_path(pattern)
+
+    if archive_pattern is None:
+        return sorted(glob(pattern))
+
+    return [
+        f"{archive}{SEPARATOR}{name}"
+        for archive in sorted(glob(archive_pattern))
+        for name in pool.get(archive).match(member_pattern)
+    ]
+
+
+def exists(path: str):
+    archive, member = split_path(path)
+
+    if archive is None:
+        return os.path.exists(path)
+
+    return os.path.exists(archive) and member in pool.get(archive).members
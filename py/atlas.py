@@ -0,0 +1,236 @@
+from dataclasses import asdict, dataclass
+
+
+DEFAULT_SHEET_SIZE = 2048
+
+
+class FrameTooLargeException(Exception):
+    pass
+
+
+@dataclass
+class AtlasRect:
+    index: int
+    sheet: int
+    x: int
+    y: int
+    width: int
+    height: int
+    trim_x: int
+    trim_y: int
+    source_width: int
+    source_height: int
+
+    def as_dict(self):
+        return asdict(self)
+
+
+class Skyline:
+    """
+    Skyline bottom-left rectangle packer for a single sheet.
+
+    The skyline is a list of [x, y, width] segments covering the sheet's width; each rectangle is placed where
+    its top edge would be lowest.
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.segments = [[0, 0, width]]
+
+    def find_position(self, width: int, height: int):
+        best = None
+
+        for i, (x, _, _) in enumerate(self.segments):
+            if x + width > self.width:
+                break
+
+            y = self.fit_height(i, width)
+
+            if y + height > self.height:
+                continue
+
+            if best is None or y < best[1]:
+                best = (i, y)
+
+        return best
+
+    def fit_height(self, index: int, width: int):
+        y = 0
+        remaining = width
+
+        while remaining > 0:
+            _, segment_y, segment_width = self.segments[index]
+            y = max(y, segment_y)
+            remaining -= segment_width
+            index += 1
+
+        return y
+
+    def insert(self, width: int, height: int):
+        """
+        Places a rectangle, returning its (x, y) position or None if it doesn't fit.
+        """
+        position = self.find_position(width, height)
+
+        if position is None:
+            return None
+
+        index, y = position
+        x = self.segments[index][0]
+        self.segments.insert(index, [x, y + height, width])
+
+        # Shrink or remove the segments now covered by the new one
+        right = x + width
+        next_index = index + 1
+
+        while next_index < len(self.segments):
+            segment = self.segments[next_index]
+
+            if segment[0] >= right:
+                break
+
+            overlap = right - segment[0]
+
+            if overlap >= segment[2]:
+                del self.segments[next_index]
+            else:
+                segment[0] += overlap
+                segment[2] -= overlap
+                break
+
+        self.merge()
+
+        return x, y
+
+    def merge(self):
+        merged = [self.segments[0]]
+
+        for segment in self.segments[1:]:
+            if segment[1] == merged[-1][1]:
+                merged[-1][2] += segment[2]
+            else:
+                merged.append(segment)
+
+        self.segments = merged
+
+
+def next_power_of_two(value: int):
+    return 1 << max(0, value - 1).bit_length()
+
+
+def trim_bounds(rows: list, width: int, height: int):
+    """
+    Returns the (x, y, width, height) bounds of a frame's non-transparent pixels, or None if it's fully transparent.
+    """
+    left = width
+    right = 0
+    top = None
+    bottom = 0
+
+    for y, row in enumerate(rows):
+        alpha = bytes(row[3::4]).rstrip(b"\0")
+
+        if not alpha:
+            continue
+
+        if top is None:
+            top = y
+
+        bottom = y + 1
+        left = min(left, len(alpha) - len(alpha.lstrip(b"\0")))
+        right = max(right, len(alpha))
+
+    if top is None:
+        return None
+
+    return left, top, right - left, bottom - top
+
+
+def pack(sizes: list, max_size: int = DEFAULT_SHEET_SIZE, padding: int = 1):
+    """
+    Packs (width, height) sizes into as many `max_size` square sheets as needed.
+
+    Returns a list of (sheet, x, y) positions in the same order as `sizes` (None for empty sizes) and the
+    power-of-two (width, height) of each sheet.
+    """
+    positions = [None] * len(sizes)
+    sheets = []
+
+    # Tallest first packs tightest on a skyline
+    order = sorted(range(len(sizes)), key=lambda x: (-sizes[x][1], -sizes[x][0], x))
+
+    for index in order:
+        width, height = sizes[index]
+
+        if width == 0 or height == 0:
+            continue
+
+        if width + padding > max_size or height + padding > max_size:
+            raise FrameTooLargeException(f"{width}x{height} frame doesn't fit in a {max_size}x{max_size} sheet")
+
+        for sheet, packer in enumerate(sheets):
+            position = packer.insert(width + padding, height + padding)
+
+            if position is not None:
+                break
+        else:
+            sheet = len(sheets)
+            sheets.append(Skyline(max_size, max_size))
+            position = sheets[sheet].insert(width + padding, height + padding)
+
+        positions[index] = (sheet, *position)
+
+    sheet_sizes = [[1, 1] for x in sheets]
+
+    for size, position in zip(sizes, positions):
+        if position is not None:
+            sheet, x, y = position
+            sheet_sizes[sheet][0] = max(sheet_sizes[sheet][0], next_power_of_two(x + size[0]))
+            sheet_sizes[sheet][1] = max(sheet_sizes[sheet][1], next_power_of_two(y + size[1]))
+
+    return positions, [tuple(size) for size in sheet_sizes]
+
+
+def build_atlas(frames: list, max_size: int = DEFAULT_SHEET_SIZE, padding: int = 1, trim: bool = False):
+    """
+    Packs decoded frames into RGBA sheets.
+
+    `frames` is a list of (rows, width, height) tuples, where rows are RGBA byte strings as returned by
+    `Frame.get_pixel_data`. Returns the sheets, each a (rows, width, height) tuple, and an `AtlasRect` per frame.
+    """
+    bounds = []
+
+    for rows, width, height in frames:
+        if not trim:
+            bounds.append((0, 0, width, height))
+        else:
+            bounds.append(trim_bounds(rows, width, height) or (0, 0, 0, 0))
+
+    positions, sheet_sizes = pack([(w, h) for _, _, w, h in bounds], max_size, padding)
+    sheets = [([bytearray(width * 4) for y in range(height)], width, height) for width, height in sheet_sizes]
+    rects = []
+
+    for index, ((rows, width, height), (trim_x, trim_y, w, h), position) in enumerate(zip(frames, bounds, positions)):
+        sheet, x, y = position if position is not None else (None, 0, 0)
+
+        if position is not None:
+            sheet_rows = sheets[sheet][0]
+
+            for row in range(h):
+                sheet_rows[y + row][x * 4:(x + w) * 4] = rows[trim_y + row][trim_x * 4:(trim_x + w) * 4]
+
+        rects.append(AtlasRect(
+            index=index,
+            sheet=sheet,
+            x=x,
+            y=y,
+            width=w,
+            height=h,
+            trim_x=trim_x,
+            trim_y=trim_y,
+            source_width=width,
+            source_height=height
+        ))
+
+    return sheets, rects
@@ -1,13 +1,26 @@
 import os
+import struct
 
-from dataclasses import astuple, dataclass
-from typing import BinaryIO
+from collections.abc import Sequence
+from dataclasses import dataclass
+from functools import cached_property, wraps
+from typing import BinaryIO, NamedTuple
 
-from utils import int32, uint8, uint32
+import metrics
+
+from utils import as_buffer, uint32
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 PALETTE_SIZE = 256
 
+FRAME_HEADER = struct.Struct("<3I2i8si")
+FILE_HEADER = struct.Struct("<4sI")
+
 
 class InvalidSignature(Exception):
     pass
@@ -23,20 +36,56 @@ class InvalidDimensionsException(Exception):
 
 class MMFile:
     signature = None
+    header_size = FILE_HEADER.size
+
+    def __init__(self, source):
+        """
+        `source` is either a seekable file handle, a path, or a bytes-like object (e.g. a memoryview of an mmap).
+        Paths and bytes-like objects are parsed in place and kept as `self.buffer`; pass that to methods
+        such as `Frame.get_pixel_data` in place of a file handle.
+        """
+        self.buffer = as_buffer(source)
+
+        if self.buffer is None:
+            with metrics.timer("verify"):
+                self.verify_file(source)
+
+            with metrics.timer("parse_header"):
+                self.parse_header(source)
+
+            with metrics.timer("parse_data"):
+                self.parse_data(source)
+        else:
+            with metrics.timer("verify"):
+                self.verify_buffer(self.buffer)
+
+            with metrics.timer("parse_header"):
+                self.unpack_header(self.buffer)
 
-    def __init__(self, fh: BinaryIO):
-        self.verify_file(fh)
-        self.parse_header(fh)
-        self.parse_data(fh)
+            with metrics.timer("parse_data"):
+                self.unpack_data(self.buffer)
 
     def verify_file(self, fh: BinaryIO):
         fh.seek(0)
-        sig = fh.read(4).decode()
-        reported_size = uint32(fh)
-        actual_size = fh.seek(0, os.SEEK_END)
+        header = fh.read(self.header_size)
+        self.verify_header(header, fh.seek(0, os.SEEK_END))
 
+    def verify_buffer(self, buffer: memoryview):
+        self.verify_header(buffer[:self.header_size], len(buffer))
+
+    def verify_header(self, header: bytes, actual_size: int):
+        """
+        Checks the signature and reported size at the start of `header` (the first `header_size` bytes of the file,
+        or fewer if the file is shorter) against the file's actual size.
+        """
         assert self.signature is not None, "signature required"
 
+        if len(header) < FILE_HEADER.size:
+            raise InvalidFileSize(f"expected at least {FILE_HEADER.size} but got {actual_size}")
+
+        sig, reported_size = FILE_HEADER.unpack_from(header)
+        sig = sig.decode(errors="replace")
+
         if sig != self.signature:
             raise InvalidSignature(f'expected "{self.signature}" but got "{sig}"')
 
@@ -49,6 +98,67 @@ class MMFile:
     def parse_data(fh: BinaryIO):
         raise NotImplementedError()
 
+    def unpack_header(buffer: memoryview):
+        raise NotImplementedError()
+
+    def unpack_data(buffer: memoryview):
+        raise NotImplementedError()
+
+
+def decoder(func):
+    """
+    Records a decoding method's time, and the frames and pixels it decodes, when metrics are enabled.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if metrics.get() is None:
+            return func(self, *args, **kwargs)
+
+        with metrics.timer("decode"):
+            result = func(self, *args, **kwargs)
+
+        metrics.count("frames_decoded")
+        metrics.count("pixels_decoded", self.width * self.height)
+
+        return result
+
+    return wrapper
+
+
+def frame_header_size(sprite_version: int):
+    """
+    Size of a frame's fixed header; version 3+ frames have two extra (unknown) values.
+    """
+    return FRAME_HEADER.size + (8 if sprite_version > 2 else 0)
+
+
+class FrameHeader(NamedTuple):
+    """
+    A frame's fixed header fields, without its row tables.
+    """
+    offset: int
+    size: int
+    width: int
+    height: int
+    centre_x: int
+    centre_y: int
+    name: str
+    palette_index: int
+
+    @classmethod
+    def from_buffer(cls, fh: BinaryIO):
+        offset = fh.tell()
+        return cls.from_fields(offset, FRAME_HEADER.unpack(fh.read(FRAME_HEADER.size)))
+
+    @classmethod
+    def unpack_from(cls, buffer: memoryview, offset: int):
+        return cls.from_fields(offset, FRAME_HEADER.unpack_from(buffer, offset))
+
+    @classmethod
+    def from_fields(cls, offset: int, fields: tuple):
+        size, width, height, centre_x, centre_y, name, palette_index = fields
+        return cls(offset, size, width, height, centre_x, centre_y, name.decode().strip("\0"), palette_index)
+
 
 @dataclass
 class Frame:
@@ -66,108 +176,373 @@ class Frame:
     @classmethod
     def from_buffer(cls, fh: BinaryIO, sprite_version: int):
         offset = fh.tell()
-        size = uint32(fh)
-        width = uint32(fh)
-        height = uint32(fh)
-        centre_x = int32(fh)
-        centre_y = int32(fh)
-        name = fh.read(8).decode().strip("\0")
-        palette_index = int32(fh)
-
-        # Unknown values
-        if sprite_version > 2:
-            fh.read(8)
-
-        delta_offsets = [None] * height
-        pixel_offsets = [None] * height
-
-        for x in range(height):
-            delta_offsets[x] = uint32(fh)
-            pixel_offsets[x] = uint32(fh)
-
-        return cls(
-            offset=offset,
-            size=size,
-            width=width,
-            height=height,
-            centre_x=centre_x,
-            centre_y=centre_y,
-            name=name,
-            palette_index=palette_index,
-            delta_offsets=delta_offsets,
-            pixel_offsets=pixel_offsets
-        )
+        data = fh.read(FRAME_HEADER.size)
+        height = FRAME_HEADER.unpack_from(data)[2]
+        data += fh.read(frame_header_size(sprite_version) - FRAME_HEADER.size + height * 8)
+
+        frame = cls.unpack_from(data, 0, sprite_version)
+        frame.offset = offset
+
+        return frame
+
+    @classmethod
+    def unpack_from(cls, buffer: memoryview, offset: int, sprite_version: int):
+        header = FrameHeader.unpack_from(buffer, offset)
+        rows = struct.unpack_from(f"<{header.height * 2}I", buffer, offset + frame_header_size(sprite_version))
+
+        return cls(*header, delta_offsets=list(rows[0::2]), pixel_offsets=list(rows[1::2]))
 
     @property
     def has_valid_dimensions(self):
         return self.width > 0 and self.height > 0
 
+    def get_palette(self, palettes: list):
+        if self.palette_index < 0 or self.palette_index >= len(palettes):
+            return palettes[0]
+
+        return palettes[self.palette_index]
+
+    def read_data(self, source):
+        """
+        Returns the frame's bytes from a file handle, or a zero-copy slice of a buffer.
+        """
+        metrics.count("bytes_read", self.size)
+
+        if isinstance(source, memoryview):
+            return source[self.offset:self.offset + self.size]
+
+        source.seek(self.offset)
+        return source.read(self.size)
+
+    @decoder
     def get_pixel_data(self, fh: BinaryIO, palettes: list):
+        """
+        Returns the frame's rows, each a `bytearray` of `width * 4` RGBA bytes. Rows were previously lists of ints;
+        indexing and iterating them still gives ints, but use `list(row)` where an actual list is needed.
+        """
         if not self.has_valid_dimensions:
             raise InvalidDimensionsException("width or height is 0")
 
         pixels = [None] * self.height
+        colours = self.get_palette(palettes).colours
+        data = self.read_data(fh)
+        row_size = self.width * 4
 
-        if self.palette_index < 0 or self.palette_index > len(palettes):
-            palette = palettes[0]
-        else:
-            palette = palettes[self.palette_index]
+        for row in range(self.height):
+            pixels[row] = bytearray()
+
+            delta_offset = self.delta_offsets[row]
+            pixel_offset = self.pixel_offsets[row]
+
+            delta_start = self.pixel_offsets[0] if (row + 1 == self.height) else self.delta_offsets[row + 1]
+
+            for x, delta in enumerate(data[delta_offset:delta_start]):
+                is_colour = x & 1
+
+                if is_colour:
+                    pixels[row] += b"".join(map(colours.__getitem__, data[pixel_offset:pixel_offset + delta]))
+                    pixel_offset += delta
+                else:
+                    pixels[row] += bytes(delta * 4)
+
+            # Runs are clipped to the frame width, as in fmt_spr.c
+            del pixels[row][row_size:]
+            pixels[row] += bytes(row_size - len(pixels[row]))
+
+        return pixels
+
+    @decoder
+    def get_index_data(self, fh: BinaryIO, transparent_index: int = None):
+        """
+        Returns rows of palette indices, with transparent pixels set to `transparent_index`.
+
+        If `transparent_index` isn't given, an index unused by the frame is chosen (as in fmt_spr.c). Returns the
+        rows and the transparent index, which is None if the frame uses every palette index.
+        """
+        if not self.has_valid_dimensions:
+            raise InvalidDimensionsException("width or height is 0")
+
+        data = self.read_data(fh)
+        spans = [None] * self.height
+        used = set()
 
+        # Colour runs are clipped to the frame width, as in fmt_spr.c; only visible pixels count as used
         for row in range(self.height):
-            pixels[row] = []
+            spans[row] = []
 
             delta_offset = self.delta_offsets[row]
             pixel_offset = self.pixel_offsets[row]
+            x = 0
 
             delta_start = self.pixel_offsets[0] if (row + 1 == self.height) else self.delta_offsets[row + 1]
-            delta_amt = delta_start - delta_offset
-            delta_values = [None] * delta_amt
 
-            for x in range(delta_amt):
-                fh.seek(self.offset + delta_offset + x)
-                delta_values[x] = uint8(fh)
+            for run, delta in enumerate(data[delta_offset:delta_start]):
+                visible = max(0, min(delta, self.width - x))
 
-            for x, delta in enumerate(delta_values):
-                is_colour = x & 1
+                if run & 1:
+                    span = data[pixel_offset:pixel_offset + visible]
+                    used.update(span)
+                    spans[row].append(span)
+                    pixel_offset += delta
+                else:
+                    spans[row].append(visible)
+
+                x += delta
+
+        if transparent_index is None:
+            unused = set(range(PALETTE_SIZE)).difference(used)
+            transparent_index = max(unused) if unused else None
+
+        pixels = [None] * self.height
+        fill = bytes((transparent_index or 0,))
+
+        for row in range(self.height):
+            pixels[row] = bytearray()
 
-                for y in range(delta):
-                    if is_colour:
-                        fh.seek(self.offset + pixel_offset + y)
-                        pixel_index = uint8(fh)
-                        pixel = palette.pixels[pixel_index]
-                    else:
-                        pixel = Pixel(0, 0, 0, 0)
+            for span in spans[row]:
+                pixels[row] += fill * span if isinstance(span, int) else span
 
-                    pixels[row].extend(pixel.as_list())
+            pixels[row] += fill * (self.width - len(pixels[row]))
+
+        return pixels, transparent_index
+
+    @decoder
+    def get_pixel_array(self, fh: BinaryIO, palettes: list):
+        """
+        Vectorised equivalent of get_pixel_data; returns a (height, width, 4) uint8 array.
+        """
+        if np is None:
+            raise ImportError("get_pixel_array requires numpy")
+
+        palette = self.get_palette(palettes)
+        data = np.frombuffer(self.read_data(fh), dtype=np.uint8)
+        out_y, out_x, src = self.expand_runs(data)
+        pixels = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+        pixels[out_y, out_x] = palette.array[data[src]]
 
         return pixels
 
+    @decoder
+    def get_index_array(self, fh: BinaryIO, transparent_index: int = None):
+        """
+        Vectorised equivalent of get_index_data; returns a (height, width) uint8 array and the transparent index.
+        """
+        if np is None:
+            raise ImportError("get_index_array requires numpy")
 
-@dataclass
+        data = np.frombuffer(self.read_data(fh), dtype=np.uint8)
+        out_y, out_x, src = self.expand_runs(data)
+
+        if transparent_index is None:
+            unused = np.flatnonzero(np.bincount(data[src], minlength=PALETTE_SIZE) == 0)
+            transparent_index = int(unused[-1]) if unused.size else None
+
+        pixels = np.full((self.height, self.width), transparent_index or 0, dtype=np.uint8)
+        pixels[out_y, out_x] = data[src]
+
+        return pixels, transparent_index
+
+    def expand_runs(self, data):
+        """
+        Returns the row, column and source byte offset of every visible coloured pixel in the frame's data.
+        """
+        if not self.has_valid_dimensions:
+            raise InvalidDimensionsException("width or height is 0")
+
+        empty = np.zeros(0, dtype=np.int64)
+
+        # Every row's deltas are stored back to back, ending where the pixel data begins
+        delta_offsets = np.array(self.delta_offsets, dtype=np.int64)
+        row_ends = np.append(delta_offsets[1:], self.pixel_offsets[0])
+        row_lengths = row_ends - delta_offsets
+        deltas = data[delta_offsets[0]:self.pixel_offsets[0]].astype(np.int64)
+
+        if deltas.size == 0:
+            return empty, empty, empty
+
+        rows = np.repeat(np.arange(self.height), row_lengths)
+        row_starts = delta_offsets - delta_offsets[0]
+        is_colour = (np.arange(deltas.size) - row_starts[rows]) & 1 == 1
+
+        # Position of each run within its row, and within the row's pixel stream
+        run_x = _row_exclusive_cumsum(deltas, rows, row_starts)
+        colours = np.where(is_colour, deltas, 0)
+        run_src = _row_exclusive_cumsum(colours, rows, row_starts)
+        run_src += np.array(self.pixel_offsets, dtype=np.int64)[rows]
+
+        run_lengths = deltas[is_colour]
+        total = int(run_lengths.sum())
+
+        if total == 0:
+            return empty, empty, empty
+
+        run_first = np.cumsum(run_lengths) - run_lengths
+        within = np.arange(total) - np.repeat(run_first, run_lengths)
+        out_x = np.repeat(run_x[is_colour], run_lengths) + within
+        out_y = np.repeat(rows[is_colour], run_lengths)
+        src = np.repeat(run_src[is_colour], run_lengths) + within
+
+        visible = out_x < self.width
+
+        return out_y[visible], out_x[visible], src[visible]
+
+
+class FrameTable(Sequence):
+    """
+    Sequence of frames which are only parsed when first accessed.
+
+    Frame offsets are found by hopping from one frame to the next (`offset + size`), and only as far as the
+    highest index requested so far.
+    """
+
+    def __init__(self, source, offset: int, count: int, sprite_version: int):
+        self.source = source
+        self.count = count
+        self.sprite_version = sprite_version
+        self.offsets = [offset] if count > 0 else []
+        self.frames = [None] * count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(self.count))]
+
+        if index < 0:
+            index += self.count
+
+        if index < 0 or index >= self.count:
+            raise IndexError("frame index out of range")
+
+        if self.frames[index] is None:
+            self.frames[index] = self.parse_frame(self.get_offset(index))
+
+            if index + 1 == len(self.offsets) < self.count:
+                self.offsets.append(self.frames[index].offset + self.frames[index].size)
+
+        return self.frames[index]
+
+    def __repr__(self):
+        parsed = sum(frame is not None for frame in self.frames)
+        return f"<FrameTable: {parsed} of {self.count} frames parsed>"
+
+    def get_offset(self, index: int):
+        while len(self.offsets) <= index:
+            offset = self.offsets[-1]
+
+            if isinstance(self.source, memoryview):
+                size = struct.unpack_from("<I", self.source, offset)[0]
+            else:
+                self.source.seek(offset)
+                size = uint32(self.source)
+
+            self.offsets.append(offset + size)
+
+        return self.offsets[index]
+
+    def parse_frame(self, offset: int):
+        if isinstance(self.source, memoryview):
+            return Frame.unpack_from(self.source, offset, self.sprite_version)
+
+        self.source.seek(offset)
+        return Frame.from_buffer(self.source, self.sprite_version)
+
+    def headers(self):
+        """
+        Returns every frame's `FrameHeader`, reading only the fixed header of each frame while hopping to the next;
+        row tables are never read. The offsets found are kept, so frames accessed later needn't be hopped to again.
+        """
+        headers = []
+        offset = self.offsets[0] if self.count > 0 else 0
+
+        for x in range(self.count):
+            if isinstance(self.source, memoryview):
+                header = FrameHeader.unpack_from(self.source, offset)
+            else:
+                self.source.seek(offset)
+                header = FrameHeader.from_buffer(self.source)
+
+            if header.size < FRAME_HEADER.size:
+                raise InvalidFileSize(f"frame {x} at {offset} has an invalid size ({header.size})")
+
+            headers.append(header)
+            offset += header.size
+
+        self.offsets = [header.offset for header in headers]
+
+        return headers
+
+
+def _row_exclusive_cumsum(values, rows, row_starts):
+    """
+    Exclusive running total of values, restarting at the first value of each row.
+    """
+    totals = np.cumsum(values) - values
+    return totals - totals[row_starts[rows]]
+
+
+@dataclass(eq=False)
 class Palette:
-    pixels: list
+    """
+    256 colours stored as one contiguous RGBA table (4 bytes per colour).
+    """
+    rgba: bytes
 
     @classmethod
     def from_buffer(cls, fh: BinaryIO):
-        pixels = [None] * PALETTE_SIZE
+        return cls.from_rgb(fh.read(PALETTE_SIZE * 3))
+
+    @classmethod
+    def unpack_from(cls, buffer: memoryview, offset: int):
+        return cls.from_rgb(buffer[offset:offset + PALETTE_SIZE * 3])
 
-        for x in range(PALETTE_SIZE):
-            pixels[x] = Pixel(r=uint8(fh), g=uint8(fh), b=uint8(fh), a=255)
+    @classmethod
+    def from_rgb(cls, rgb: bytes):
+        rgb = bytes(rgb)
+        rgba = bytearray(b"\xff" * PALETTE_SIZE * 4)
+        rgba[0::4] = rgb[0::3]
+        rgba[1::4] = rgb[1::3]
+        rgba[2::4] = rgb[2::3]
 
-        return cls(pixels)
+        return cls(bytes(rgba))
 
+    def __eq__(self, other):
+        return isinstance(other, Palette) and self.rgba == other.rgba
 
-class GreyscalePalette:
+    @cached_property
+    def colours(self):
+        """
+        Each colour as a 4 byte RGBA string, for joining into rows of pixels.
+        """
+        return [self.rgba[x:x + 4] for x in range(0, len(self.rgba), 4)]
+
+    @property
+    def pixels(self):
+        return [Pixel(*colour) for colour in self.colours]
+
+    @cached_property
+    def array(self):
+        """
+        The RGBA table as a (256, 4) uint8 NumPy array.
+        """
+        return np.frombuffer(self.rgba, dtype=np.uint8).reshape(PALETTE_SIZE, 4)
+
+
+class GreyscalePalette(Palette):
     def __init__(self):
-        self.pixels = [Pixel(x, x, x, 255) for x in range(PALETTE_SIZE)]
+        super().__init__(bytes(channel for x in range(PALETTE_SIZE) for channel in (x, x, x, 255)))
 
 
-@dataclass
-class Pixel:
+# Shared by every palette-less sprite (e.g. timer.spr)
+GREYSCALE_PALETTE = GreyscalePalette()
+
+
+class Pixel(NamedTuple):
     r: int
     g: int
     b: int
     a: int
 
     def as_list(self):
-        return list(astuple(self))
+        return list(self)
@@ -0,0 +1,288 @@
+"""
+Decoder benchmarks against synthetic sprites, so no game assets are needed.
+
+    py benchmark.py --frames 200 --width 64 --height 96 --output results.json
+    py benchmark.py --version 2 --transparency 0.8 --compare results.json
+
+Header parsing, `Frame.from_buffer`, pixel decoding and PNG export are timed separately; each is repeated and
+the best time kept. Peak memory is measured in a separate, untimed run, as tracing allocations slows Python down.
+"""
+
+import argparse
+import io
+import json
+import platform
+import random
+import struct
+import sys
+import time
+import tracemalloc
+
+from dataclasses import asdict, dataclass
+
+import png
+
+from base_classes import FRAME_HEADER, Frame, PALETTE_SIZE, frame_header_size
+from mm_files import FontFile, SpriteFile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+@dataclass
+class SyntheticSprite:
+    frame_count: int = 100
+    width: int = 64
+    height: int = 64
+    palette_count: int = 1
+    version: int = 3
+    transparency: float = 0.5
+    max_run: int = 16
+    font: bool = False
+    seed: int = 0
+
+
+def generate_runs(rnd: random.Random, width: int, transparency: float, max_run: int):
+    """
+    Splits a row into alternating transparent and colour run lengths, starting with a transparent run.
+    `transparency` is roughly the fraction of pixels in transparent runs.
+    """
+    transparent_max = max(1, round(2 * max_run * transparency))
+    colour_max = round(2 * max_run * (1 - transparency))
+
+    runs = []
+    x = 0
+
+    while x < width:
+        # Transparent runs may be empty, colour runs only if every pixel is transparent
+        if len(runs) % 2 == 0:
+            length = rnd.randint(0, transparent_max)
+        else:
+            length = rnd.randint(min(1, colour_max), colour_max)
+
+        length = min(length, width - x, 255)
+        runs.append(length)
+        x += length
+
+    return runs
+
+
+def generate_frame(rnd: random.Random, config: SyntheticSprite, index: int):
+    header_size = frame_header_size(config.version)
+    rows = []
+
+    for y in range(config.height):
+        runs = generate_runs(rnd, config.width, config.transparency, config.max_run)
+        pixels = bytes(rnd.randrange(256) for x in range(sum(runs[1::2])))
+        rows.append((bytes(runs), pixels))
+
+    # Row table, then every row's deltas, then every row's pixels
+    position = header_size + config.height * 8
+    delta_offsets = []
+    pixel_offsets = []
+
+    for deltas, _ in rows:
+        delta_offsets.append(position)
+        position += len(deltas)
+
+    for _, pixels in rows:
+        pixel_offsets.append(position)
+        position += len(pixels)
+
+    name = f"F{index:07}".encode()
+    palette_index = index % max(config.palette_count, 1)
+
+    data = bytearray(FRAME_HEADER.pack(position, config.width, config.height, -1, -2, name, palette_index))
+    data.extend(bytes(header_size - FRAME_HEADER.size))
+
+    for row in zip(delta_offsets, pixel_offsets):
+        data.extend(struct.pack("<2I", *row))
+
+    for deltas, _ in rows:
+        data.extend(deltas)
+
+    for _, pixels in rows:
+        data.extend(pixels)
+
+    return data
+
+
+def generate_sprite(config: SyntheticSprite):
+    """
+    Returns the bytes of a valid `SPR\\0` (or `SFT\\0`) file built from `config`.
+    """
+    rnd = random.Random(config.seed)
+
+    if config.font:
+        data = bytearray(b"SFT\0" + struct.pack("<7I", 0, config.version, config.frame_count, 0, 0, 0, 0))
+        data.extend(struct.pack("<2I", config.palette_count, 0))
+    else:
+        data = bytearray(b"SPR\0" + struct.pack("<5I", 0, config.version, config.frame_count, config.palette_count, 0))
+
+    for x in range(config.palette_count):
+        data.extend(bytes(rnd.randrange(256) for x in range(PALETTE_SIZE * 3)))
+
+    # Frame table; version 2 sprites have one entry fewer
+    table_size = config.frame_count - 1 if config.version == 2 else config.frame_count
+    data.extend(bytes(max(table_size, 0) * 4))
+
+    for x in range(config.frame_count):
+        data.extend(generate_frame(rnd, config, x))
+
+    struct.pack_into("<I", data, 4, len(data))
+
+    return bytes(data)
+
+
+def parse_headers(data: bytes, sprite_class):
+    return sprite_class(io.BytesIO(data), lazy=True)
+
+
+def parse_frames(data: bytes, sprite, offsets: list):
+    fh = io.BytesIO(data)
+
+    for offset in offsets:
+        fh.seek(offset)
+        Frame.from_buffer(fh, sprite.version)
+
+
+def decode_frames(sprite, engine: str):
+    for frame in sprite.frames:
+        if engine == "numpy":
+            frame.get_pixel_array(sprite.buffer, sprite.palettes)
+        else:
+            frame.get_pixel_data(sprite.buffer, sprite.palettes)
+
+
+def export_frames(sprite):
+    for frame in sprite.frames:
+        rows = frame.get_pixel_data(sprite.buffer, sprite.palettes)
+        png.Writer(frame.width, frame.height, greyscale=False, alpha=True).write(io.BytesIO(), rows)
+
+
+def measure(func, args: tuple, repeat: int):
+    """
+    Returns the best time of `repeat` runs, and the peak memory allocated by one further run.
+    """
+    best = None
+
+    for x in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak
+
+
+def run(config: SyntheticSprite, repeat: int = 5):
+    sprite_class = FontFile if config.font else SpriteFile
+    data = generate_sprite(config)
+    sprite = sprite_class(data)
+    offsets = [frame.offset for frame in sprite.frames]
+    pixel_count = config.frame_count * config.width * config.height
+
+    benchmarks = {
+        "parse_headers": (parse_headers, (data, sprite_class)),
+        "frame_from_buffer": (parse_frames, (data, sprite, offsets)),
+        "get_pixel_data": (decode_frames, (sprite, "python")),
+        "png_export": (export_frames, (sprite,)),
+    }
+
+    if np is not None:
+        benchmarks["get_pixel_array"] = (decode_frames, (sprite, "numpy"))
+
+    results = {}
+
+    for name, (func, args) in benchmarks.items():
+        seconds, peak = measure(func, args, repeat)
+        results[name] = {
+            "seconds": seconds,
+            "frames_per_second": config.frame_count / seconds if seconds else None,
+            "pixels_per_second": pixel_count / seconds if seconds else None,
+            "peak_memory": peak,
+        }
+
+    return {
+        "config": asdict(config),
+        "file_size": len(data),
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__ if np is not None else None,
+        "results": results,
+    }
+
+
+def compare(results: dict, baseline: dict):
+    """
+    Prints each benchmark's time relative to a previous run (above 1.00x is slower).
+    """
+    if baseline["config"] != results["config"]:
+        print("warning: baseline was run with a different configuration")
+
+    for name, result in results["results"].items():
+        if name in baseline["results"]:
+            ratio = result["seconds"] / baseline["results"][name]["seconds"]
+            print(f"{name:<20} {ratio:.2f}x")
+
+
+def main(args: argparse.Namespace):
+    config = SyntheticSprite(
+        frame_count=args.frames,
+        width=args.width,
+        height=args.height,
+        palette_count=args.palettes,
+        version=args.version,
+        transparency=args.transparency,
+        max_run=args.max_run,
+        font=args.font,
+        seed=args.seed,
+    )
+    results = run(config, args.repeat)
+
+    for name, result in results["results"].items():
+        print(
+            f"{name:<20} {result['seconds'] * 1000:10.2f} ms"
+            f" {result['frames_per_second']:12.0f} frames/s"
+            f" {result['pixels_per_second']:14.0f} pixels/s"
+            f" {result['peak_memory'] / 1024:10.0f} KiB peak"
+        )
+
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(results, json.load(fh))
+
+    if args.output:
+        with open(args.output, mode="w") as fh:
+            json.dump(results, fh, indent=1)
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=SyntheticSprite.frame_count, help="number of frames")
+    parser.add_argument("--width", type=int, default=SyntheticSprite.width, help="frame width")
+    parser.add_argument("--height", type=int, default=SyntheticSprite.height, help="frame height")
+    parser.add_argument("--palettes", type=int, default=SyntheticSprite.palette_count, help="number of palettes (0 for greyscale)")
+    parser.add_argument("--version", type=int, default=SyntheticSprite.version, help="sprite version (2 has shorter frame headers)")
+    parser.add_argument("--transparency", type=float, default=SyntheticSprite.transparency, help="approximate fraction of transparent pixels")
+    parser.add_argument("--max-run", type=int, default=SyntheticSprite.max_run, help="average length of a pair of runs")
+    parser.add_argument("--font", action="store_true", help="generate an SFT file instead of an SPR file")
+    parser.add_argument("--seed", type=int, default=SyntheticSprite.seed, help="random seed")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per benchmark; the best is kept")
+    parser.add_argument("-o", "--output", help="save the results to a JSON file")
+    parser.add_argument("--compare", help="compare against results saved by a previous run")
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,416 @@
+"""
+SQLite catalog of a game install's sprites, frames and animations.
+
+    py catalog.py index "C:\\Magic & Mayhem" -c catalog.db --jobs 8
+    py catalog.py find -c catalog.db --frame RALA0001
+    py catalog.py find -c catalog.db --sprite Ralph.spr
+    py catalog.py inspect "Creatures/*.spr" --format csv -o frames.csv
+
+Indexing is incremental: files whose size and modification time are unchanged since the last run are skipped,
+and files that have been removed are dropped from the catalog. `inspect` reads frame metadata straight from
+sprites, without a catalog.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import archives
+
+from base_classes import Frame, FrameHeader
+from mm_files import AniFile, FontFile, SpriteFile
+from utils import as_buffer
+
+
+FILE_TYPES = {
+    ".spr": SpriteFile,
+    ".sft": FontFile,
+    ".ani": AniFile,
+}
+
+# Bumped whenever SCHEMA changes; older catalogs are rebuilt from scratch
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    error TEXT
+);
+
+CREATE TABLE IF NOT EXISTS sprites (
+    file_id INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+    version INTEGER NOT NULL,
+    frame_count INTEGER NOT NULL,
+    palette_count INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS frames (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    frame_index INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    centre_x INTEGER NOT NULL,
+    centre_y INTEGER NOT NULL,
+    name TEXT NOT NULL COLLATE NOCASE,
+    palette_index INTEGER NOT NULL,
+    PRIMARY KEY (file_id, frame_index)
+);
+
+CREATE TABLE IF NOT EXISTS animations (
+    file_id INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+    version INTEGER NOT NULL,
+    frame_count INTEGER NOT NULL,
+    animation_count INTEGER NOT NULL,
+    sprite_file TEXT NOT NULL,
+    sprite_name TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS frames_name ON frames (name);
+CREATE INDEX IF NOT EXISTS animations_sprite_name ON animations (sprite_name);
+"""
+
+
+def find_files(root: str):
+    return sorted(
+        os.path.join(directory, name)
+        for directory, dirs, files in os.walk(root)
+        for name in files
+        if Path(name).suffix.lower() in FILE_TYPES
+    )
+
+
+def sprite_name(sprite_file: str):
+    """
+    Lower-case file name of an animation's sprite, which may be stored with a Windows path.
+    """
+    return sprite_file.replace("\\", "/").rsplit("/", 1)[-1].lower()
+
+
+def scan_file(path: str):
+    """
+    Parses a file's headers and frame table. Returns a dict of the rows to store for it.
+    """
+    file_type = Path(path).suffix.lower()
+    parsed = FILE_TYPES[file_type](path, lazy=True) if file_type != ".ani" else AniFile(path)
+
+    if file_type == ".ani":
+        return {
+            "animation": (parsed.version, parsed.frame_count, parsed.animation_count, parsed.sprite_file, sprite_name(parsed.sprite_file)),
+        }
+
+    return {
+        "sprite": (parsed.version, parsed.frame_count, parsed.palette_count),
+        "frames": [(x, *header) for x, header in enumerate(parsed.frame_headers())],
+    }
+
+
+def scan_task(path: str):
+    try:
+        return scan_file(path), None
+    except Exception as e:
+        return None, repr(e)
+
+
+def inspect_sprite(path: str):
+    """
+    Returns a sprite's header and every frame's header fields as a dict, without reading the frames' row tables.
+    `path` may be an archive member.
+    """
+    source = archives.read_member(path) if archives.is_archive_path(path) else path
+    sprite = FILE_TYPES[Path(path).suffix.lower()](source, lazy=True)
+
+    return {
+        "file": path,
+        "version": sprite.version,
+        "frame_count": sprite.frame_count,
+        "palette_count": sprite.palette_count,
+        "frames": [{"index": x, **header._asdict()} for x, header in enumerate(sprite.frame_headers())],
+    }
+
+
+def inspect_task(path: str):
+    try:
+        return inspect_sprite(path), None
+    except Exception as e:
+        return None, repr(e)
+
+
+class Catalog:
+    def __init__(self, db_path: str):
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.db.executescript("""
+                DROP TABLE IF EXISTS frames;
+                DROP TABLE IF EXISTS sprites;
+                DROP TABLE IF EXISTS animations;
+                DROP TABLE IF EXISTS files;
+            """)
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def index(self, root: str, jobs: int = 1):
+        """
+        Adds new and changed files below `root`, and removes those which no longer exist.
+        Returns a dict of counts: added, updated, unchanged, removed and failed.
+        """
+        root = os.path.abspath(root)
+        # abspath keeps the trailing separator of a drive or filesystem root, so join rather than append one
+        prefix = os.path.join(root, "")
+        known = {
+            row["path"]: (row["id"], row["size"], row["mtime_ns"])
+            for row in self.db.execute(
+                "SELECT id, path, size, mtime_ns FROM files WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix)
+            )
+        }
+
+        counts = dict.fromkeys(("added", "updated", "unchanged", "removed", "failed"), 0)
+        changed = []
+
+        for path in find_files(root):
+            stat = os.stat(path)
+            previous = known.pop(path, None)
+
+            if previous is not None and previous[1:] == (stat.st_size, stat.st_mtime_ns):
+                counts["unchanged"] += 1
+                continue
+
+            changed.append((path, stat, previous))
+
+        paths = [path for path, _, _ in changed]
+        executor = ProcessPoolExecutor(max_workers=jobs) if jobs != 1 and paths else None
+        results = executor.map(scan_task, paths, chunksize=16) if executor else map(scan_task, paths)
+
+        try:
+            self.write(changed, results, known, counts)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        return counts
+
+    def write(self, changed: list, results, removed: dict, counts: dict):
+        with self.db:
+            for (path, stat, previous), (records, error) in zip(changed, results):
+                if previous is not None:
+                    self.db.execute("DELETE FROM files WHERE id = ?", (previous[0],))
+
+                self.store(path, stat, records, error)
+                counts["updated" if previous is not None else "added"] += 1
+                counts["failed"] += error is not None
+
+            for file_id, _, _ in removed.values():
+                self.db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+                counts["removed"] += 1
+
+    def store(self, path: str, stat: os.stat_result, records: dict, error: str):
+        file_type = Path(path).suffix.lower()
+        cursor = self.db.execute(
+            "INSERT INTO files (path, name, type, size, mtime_ns, error) VALUES (?, ?, ?, ?, ?, ?)",
+            (path, os.path.basename(path).lower(), file_type[1:], stat.st_size, stat.st_mtime_ns, error)
+        )
+        file_id = cursor.lastrowid
+
+        if records is None:
+            return
+
+        if "animation" in records:
+            self.db.execute("INSERT INTO animations VALUES (?, ?, ?, ?, ?, ?)", (file_id, *records["animation"]))
+        else:
+            self.db.execute("INSERT INTO sprites VALUES (?, ?, ?, ?)", (file_id, *records["sprite"]))
+            self.db.executemany(
+                "INSERT INTO frames VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(file_id, *frame) for frame in records["frames"]]
+            )
+
+    def find_frames(self, name: str):
+        """
+        Frames whose name matches `name` (case-insensitive; SQL LIKE wildcards are allowed).
+        """
+        return self.db.execute(
+            """
+            SELECT files.path, sprites.version, frames.*
+            FROM frames
+            JOIN files ON files.id = frames.file_id
+            JOIN sprites ON sprites.file_id = frames.file_id
+            WHERE frames.name LIKE ?
+            ORDER BY files.path, frames.frame_index
+            """,
+            (name,)
+        ).fetchall()
+
+    def find_animations(self, sprite_file: str):
+        """
+        Animation files which reference the named sprite (e.g. "Ralph.spr").
+        """
+        return self.db.execute(
+            """
+            SELECT files.path, animations.*
+            FROM animations
+            JOIN files ON files.id = animations.file_id
+            WHERE animations.sprite_name = ?
+            ORDER BY files.path
+            """,
+            (sprite_name(sprite_file),)
+        ).fetchall()
+
+    def find_sprites(self, ani_path: str):
+        """
+        Sprite files matching the name an animation file references.
+        """
+        return self.db.execute(
+            """
+            SELECT sprite.path
+            FROM files AS ani
+            JOIN animations ON animations.file_id = ani.id
+            JOIN files AS sprite ON sprite.name = animations.sprite_name
+            WHERE ani.path = ?
+            ORDER BY sprite.path
+            """,
+            (os.path.abspath(ani_path),)
+        ).fetchall()
+
+    def failed(self):
+        return self.db.execute("SELECT path, error FROM files WHERE error IS NOT NULL ORDER BY path").fetchall()
+
+
+def load_frame(row: sqlite3.Row):
+    """
+    Parses a frame found with `Catalog.find_frames` directly from its offset, without reading the rest of the file.
+    Returns the frame and the file's buffer, to pass to methods such as `Frame.get_pixel_data`.
+    """
+    buffer = as_buffer(row["path"])
+    return Frame.unpack_from(buffer, row["offset"], row["version"]), buffer
+
+
+def index_command(args: argparse.Namespace):
+    with Catalog(args.catalog) as catalog:
+        counts = catalog.index(args.root, args.jobs)
+
+        for path, error in catalog.failed():
+            print(f"failed to index {path}: {error}")
+
+    print(", ".join(f"{count} {name}" for name, count in counts.items()))
+
+    return 1 if counts["failed"] else 0
+
+
+def write_inspect_csv(fh, sprites):
+    writer = csv.writer(fh, lineterminator="\n")
+    writer.writerow(("file", "version", "index", *FrameHeader._fields))
+
+    for sprite in sprites:
+        for frame in sprite["frames"]:
+            writer.writerow((sprite["file"], sprite["version"], *frame.values()))
+
+
+def inspect_command(args: argparse.Namespace):
+    paths = []
+
+    for pattern in args.inputs:
+        if os.path.isdir(pattern):
+            paths.extend(path for path in find_files(pattern) if Path(path).suffix.lower() != ".ani")
+        else:
+            paths.extend(path for path in archives.expand(pattern) if Path(path).suffix.lower() in (".spr", ".sft"))
+
+    executor = ProcessPoolExecutor(max_workers=args.jobs) if args.jobs != 1 and paths else None
+    results = executor.map(inspect_task, paths, chunksize=16) if executor else map(inspect_task, paths)
+    sprites = []
+    failed = 0
+
+    try:
+        for path, (sprite, error) in zip(paths, results):
+            if error is not None:
+                print(f"failed to inspect {path}: {error}", file=sys.stderr)
+                failed += 1
+            else:
+                sprites.append(sprite)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    fh = open(args.output, mode="w", newline="") if args.output else sys.stdout
+
+    try:
+        if args.format == "csv":
+            write_inspect_csv(fh, sprites)
+        else:
+            json.dump(sprites, fh, indent=1)
+            fh.write("\n")
+    finally:
+        if fh is not sys.stdout:
+            fh.close()
+
+    return 1 if failed else 0
+
+
+def find_command(args: argparse.Namespace):
+    with Catalog(args.catalog) as catalog:
+        if args.frame:
+            for row in catalog.find_frames(args.frame):
+                print(f"{row['path']} #{row['frame_index']} {row['name']} {row['width']}x{row['height']} @ {row['offset']}")
+
+        if args.sprite:
+            for row in catalog.find_animations(args.sprite):
+                print(f"{row['path']} ({row['animation_count']} animations, {row['frame_count']} frames)")
+
+        if args.ani:
+            for row in catalog.find_sprites(args.ani):
+                print(row["path"])
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    index_parser = subparsers.add_parser("index", help="scan a game directory into the catalog")
+    index_parser.add_argument("root", help="game directory")
+    index_parser.add_argument("-c", "--catalog", default="catalog.db", help="catalog database (default: catalog.db)")
+    index_parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes (default: 1)")
+    index_parser.set_defaults(func=index_command)
+
+    find_parser = subparsers.add_parser("find", help="query the catalog")
+    find_parser.add_argument("-c", "--catalog", default="catalog.db", help="catalog database (default: catalog.db)")
+    find_parser.add_argument("--frame", help='frames with this name (SQL LIKE wildcards allowed, e.g. "RALA%%")')
+    find_parser.add_argument("--sprite", help="animation files which reference this sprite")
+    find_parser.add_argument("--ani", help="sprite files referenced by this animation file")
+    find_parser.set_defaults(func=find_command)
+
+    inspect_parser = subparsers.add_parser("inspect", help="print sprites' frame metadata, without reading their pixel data")
+    inspect_parser.add_argument("inputs", nargs="+", help='sprite files, directories or glob patterns (e.g. "Creatures/*.spr" or "assets.zip::*.spr")')
+    inspect_parser.add_argument("-f", "--format", choices=("json", "csv"), default="json", help="output format (default: json)")
+    inspect_parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    inspect_parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes (default: 1)")
+    inspect_parser.set_defaults(func=inspect_command)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,100 @@
+"""
+Content-addressed frame deduplication for exports.
+
+Frames are identified by `hash_pixels` (their dimensions, run-length encoded data and palette), so repeated
+frames are only decoded and encoded once, whether they repeat within a sprite or across sprites. Each duplicate
+is then either hard linked to the first copy's output (falling back to a copy where links aren't supported),
+or listed in a `dedup.json` reference file instead of being written.
+"""
+
+import json
+import os
+import shutil
+
+from manifest import hash_pixels
+
+
+DEDUP_LINK = "link"
+DEDUP_REFERENCE = "reference"
+
+REFERENCES_NAME = "dedup.json"
+
+
+class FrameDeduplicator:
+    def __init__(self, mode: str = DEDUP_LINK):
+        self.mode = mode
+        self.originals = {}
+        self.duplicates = []
+        self.frame_count = 0
+
+    def filter(self, file_path: str, sprite, indices: list, output_paths: list):
+        """
+        Returns the indices of frames which haven't been seen before, and records the rest as duplicates.
+        `output_paths` are the output paths of `indices`.
+        """
+        unique = []
+
+        for x, output_path in zip(indices, output_paths):
+            frame = sprite.frames[x]
+            key = hash_pixels(sprite, x)
+            self.frame_count += 1
+
+            if key in self.originals:
+                self.duplicates.append((file_path, output_path, *self.originals[key], frame.width * frame.height * 4))
+            else:
+                self.originals[key] = (file_path, output_path)
+                unique.append(x)
+
+        return unique
+
+    def apply(self, output_dir: str, failed: dict):
+        """
+        Links (or references) every duplicate to its original, once the originals have been exported.
+        Returns a summary of what was saved.
+        """
+        references = {}
+        saved_bytes = 0
+        saved_pixels = 0
+        saved_frames = 0
+
+        for file_path, output_path, original_file_path, original_path, pixel_bytes in self.duplicates:
+            if original_file_path in failed:
+                failed.setdefault(file_path, Exception(f"original frame {original_path} wasn't exported"))
+                continue
+
+            if self.mode == DEDUP_REFERENCE:
+                references[os.path.relpath(output_path, output_dir)] = os.path.relpath(original_path, output_dir)
+
+                # Duplicates written by an earlier run without deduplication
+                if os.path.exists(output_path) and not os.path.samefile(output_path, original_path):
+                    os.remove(output_path)
+            else:
+                link(original_path, output_path)
+
+            saved_bytes += os.path.getsize(original_path)
+            saved_pixels += pixel_bytes
+            saved_frames += 1
+
+        if self.mode == DEDUP_REFERENCE:
+            with open(os.path.join(output_dir, REFERENCES_NAME), mode="w") as fh:
+                json.dump(references, fh, indent=1)
+
+        return {
+            "frames": self.frame_count,
+            "duplicate_frames": saved_frames,
+            "saved_output_bytes": saved_bytes,
+            "saved_decoded_bytes": saved_pixels,
+        }
+
+
+def link(original_path: str, output_path: str):
+    if os.path.exists(output_path):
+        if os.path.samefile(original_path, output_path):
+            return
+
+        os.remove(output_path)
+
+    try:
+        os.link(original_path, output_path)
+    except OSError:
+        shutil.copyfile(original_path, output_path)
@@ -1,53 +1,483 @@
 import argparse
+import io
+import json
 import os
+import sys
 
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 import png
 
-from mm_files import FontFile, SpriteFile
+import archives
+import metrics
+
+from atlas import DEFAULT_SHEET_SIZE, build_atlas
+from dedup import DEDUP_LINK, DEDUP_REFERENCE, FrameDeduplicator
+from frame_cache import enable_shared_cache, get_shared_cache
+from manifest import ExportManifest, hash_file, hash_frame, outputs_exist, remove_outputs, source_stat
+from mm_files import FontFile, SpriteFile, read_sprite_stream
+
+
+# Frames per process pool task; small enough that one large sprite is spread across every worker
+FRAMES_PER_TASK = 32
+
+
+def get_sprite_class(file_path: str):
+    file_ext = Path(file_path).suffix.lower()
+
+    if file_ext == ".sft":
+        return FontFile
+    elif file_ext == ".spr":
+        return SpriteFile
+
+    return None
+
+
+def sprite_base_name(file_path: str):
+    """
+    Name of a sprite's outputs: its file name without the extension, taken from the member for archive paths.
+    """
+    return Path(archives.split_path(file_path)[1]).stem
+
+
+@lru_cache(maxsize=8)
+def load_sprite(file_path: str):
+    # Archive members are decoded from memory, without being extracted
+    if archives.is_archive_path(file_path):
+        return get_sprite_class(file_path)(archives.read_member(file_path), lazy=True)
+
+    return get_sprite_class(file_path)(file_path, lazy=True)
+
+
+def decode_frame(file_path: str, sprite, index: int, engine: str):
+    frame = sprite.frames[index]
+    cache = get_shared_cache()
+
+    if cache is not None:
+        pixels = cache.get_pixels(file_path, sprite, index, engine)
+    elif engine == "numpy":
+        pixels = frame.get_pixel_array(sprite.buffer, palettes=sprite.palettes)
+    else:
+        pixels = frame.get_pixel_data(sprite.buffer, palettes=sprite.palettes)
+
+    if engine == "numpy":
+        pixels = pixels.reshape(frame.height, frame.width * 4)
+
+    return pixels
+
+
+def write_png(output_path: str, writer: png.Writer, rows):
+    """
+    Encodes a PNG in memory then writes it out, so encoding and disk writes are timed separately.
+    """
+    output = io.BytesIO()
+
+    with metrics.timer("encode_png"):
+        writer.write(output, rows)
+
+    # Written in full then renamed over the target, which replaces rather than writes through any hard links
+    # to it (e.g. duplicates linked by --dedup link)
+    temp_path = output_path + ".tmp"
+
+    with metrics.timer("write"):
+        with open(temp_path, mode="wb") as fh:
+            fh.write(output.getbuffer())
+
+        os.replace(temp_path, output_path)
+
+
+def rgba_writer(frame):
+    return png.Writer(frame.width, frame.height, greyscale=False, alpha=True)
+
+
+def png_palette(palette, transparent_index: int):
+    colours = [tuple(colour) for colour in palette.colours]
+    colours[transparent_index] = (0, 0, 0, 0)
+
+    return colours
+
+
+def save_indexed_frame(output_path: str, sprite, index: int, engine: str):
+    """
+    Writes a frame as an 8-bit paletted PNG, with transparency stored in a tRNS chunk.
+    Returns False if the frame uses all 256 palette indices, leaving no index free for transparency.
+    """
+    frame = sprite.frames[index]
+
+    if engine == "numpy":
+        pixels, transparent_index = frame.get_index_array(sprite.buffer)
+    else:
+        pixels, transparent_index = frame.get_index_data(sprite.buffer)
+
+    if transparent_index is None:
+        return False
+
+    palette = png_palette(frame.get_palette(sprite.palettes), transparent_index)
+    write_png(output_path, png.Writer(frame.width, frame.height, palette=palette, bitdepth=8), pixels)
+
+    return True
+
+
+def frame_file_name(index: int, frame_count: int):
+    return f"{index+1:>0{len(str(frame_count))}}.png"
+
+
+def export_frames(file_path: str, output_dir: str, indices: list, engine: str, indexed: bool = False, verbose: bool = False):
+    with metrics.source(file_path):
+        sprite = load_sprite(file_path)
+        base_name = sprite_base_name(file_path)
+
+        for x in indices:
+            if verbose:
+                print(f"exporting {base_name} frame {x+1} of {sprite.frame_count}")
+
+            output_path = os.path.join(output_dir, frame_file_name(x, sprite.frame_count))
+
+            if indexed and save_indexed_frame(output_path, sprite, x, engine):
+                continue
+
+            pixels = decode_frame(file_path, sprite, x, engine)
+            write_png(output_path, rgba_writer(sprite.frames[x]), pixels)
+
+    return len(indices)
+
+
+def export_stream(stream, output_dir: str, engine: str, verbose: bool = False):
+    """
+    Exports every frame of a sprite read forward-only from a stream (e.g. stdin), one frame at a time.
+    """
+    sprite = read_sprite_stream(stream)
+    pad = len(str(sprite.frame_count))
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    for x, (frame, pixels) in enumerate(sprite.stream_frames(stream, engine)):
+        if verbose:
+            print(f"exporting frame {x+1} of {sprite.frame_count}")
+
+        if pixels is None:
+            continue
+
+        if engine == "numpy":
+            pixels = pixels.reshape(frame.height, frame.width * 4)
+
+        write_png(os.path.join(output_dir, f"{x+1:>0{pad}}.png"), rgba_writer(frame), pixels)
+
+    return sprite.frame_count
+
+
+def export_atlas(file_path: str, output_dir: str, engine: str, sheet_size: int, trim: bool, verbose: bool = False):
+    with metrics.source(file_path):
+        sprite = load_sprite(file_path)
+        base_name = sprite_base_name(file_path)
+        frames = []
+
+        if verbose:
+            print(f"packing {base_name} ({sprite.frame_count} frames)")
+
+        for x, frame in enumerate(sprite.frames):
+            if not frame.has_valid_dimensions:
+                frames.append(([], 0, 0))
+                continue
+
+            pixels = decode_frame(file_path, sprite, x, engine)
+
+            if engine == "numpy":
+                pixels = list(map(bytes, pixels))
+
+            frames.append((pixels, frame.width, frame.height))
+
+        with metrics.timer("pack"):
+            sheets, rects = build_atlas(frames, max_size=sheet_size, trim=trim)
+
+        index = {
+            "sprite": os.path.basename(file_path),
+            "sheets": [],
+            "frames": [],
+        }
+
+        for x, (rows, width, height) in enumerate(sheets):
+            sheet_name = f"{base_name}_{x}.png"
+            write_png(os.path.join(output_dir, sheet_name), png.Writer(width, height, greyscale=False, alpha=True), rows)
+
+            index["sheets"].append({"file": sheet_name, "width": width, "height": height})
+
+        for frame, rect in zip(sprite.frames, rects):
+            index["frames"].append({
+                "name": frame.name,
+                "centre_x": frame.centre_x,
+                "centre_y": frame.centre_y,
+                "palette_index": frame.palette_index,
+                **rect.as_dict(),
+            })
+
+        with open(os.path.join(output_dir, f"{base_name}.json"), mode="w") as fh:
+            json.dump(index, fh, indent=1)
+
+        return sprite.frame_count
+
+
+def atlas_outputs(output_dir: str, base_name: str):
+    return sorted(
+        name for name in os.listdir(output_dir)
+        if name == f"{base_name}.json" or (name.startswith(f"{base_name}_") and name.endswith(".png"))
+    )
+
+
+def plan_export(file_path: str, output_dir: str, manifest: ExportManifest, atlas: bool):
+    """
+    Compares a source file against the manifest. Returns the indices of the frames to export (all of them for an
+    atlas, unless nothing changed), the outputs to remove, and the file's new manifest entry.
+    """
+    entry = manifest.get(file_path)
+    stat = source_stat(file_path)
+
+    if entry is not None and (entry["output_dir"] != output_dir or not outputs_exist(entry)):
+        entry = None
+
+    # Files are only hashed if their size or modification time has changed, and only parsed if their hash has
+    if entry is not None and entry["stat"] == stat:
+        return [], [], entry
+
+    file_hash = hash_file(file_path)
+
+    if entry is not None and entry["hash"] == file_hash:
+        return [], [], {**entry, "stat": stat}
+
+    sprite = load_sprite(file_path)
+    new_entry = {"stat": stat, "hash": file_hash, "output_dir": output_dir, "frames": [], "outputs": []}
+
+    if atlas:
+        return list(range(sprite.frame_count)), atlas_outputs(output_dir, sprite_base_name(file_path)), new_entry
+
+    new_entry["frames"] = [hash_frame(sprite, x) for x in range(sprite.frame_count)]
+    new_entry["outputs"] = [frame_file_name(x, sprite.frame_count) for x in range(sprite.frame_count)]
+
+    previous = dict(zip(entry["outputs"], entry["frames"])) if entry is not None else {}
+    indices = [
+        x for x, (frame_hash, output) in enumerate(zip(new_entry["frames"], new_entry["outputs"]))
+        if previous.get(output) != frame_hash
+    ]
+    stale = sorted(set(previous) - set(new_entry["outputs"]))
+
+    return indices, stale, new_entry
 
 
 def main(args: argparse.Namespace):
-    for file_path in glob(args.input):
-        if not os.path.exists(file_path):
-            print(f"file not found: {file_path}")
+    tasks = {}
+    failed = {}
+    cache_bytes = args.cache_mb * 1024 * 1024
+    collector = metrics.enable() if args.profile else None
+
+    if cache_bytes:
+        enable_shared_cache(cache_bytes)
+
+    if args.input == "-":
+        try:
+            with metrics.source(args.stdin_name):
+                export_stream(sys.stdin.buffer, os.path.join(args.dir, args.stdin_name), args.engine, verbose=True)
+        except Exception as e:
+            print(f"failed to export stdin: {e!r}")
+            return 1
+        finally:
+            if collector is not None:
+                collector.save(args.profile)
+
+        return 0
+
+    manifest = None
+    entries = {}
+    unchanged = 0
+    dedup = FrameDeduplicator(args.dedup) if args.dedup else None
+
+    if args.incremental:
+        Path(args.dir).mkdir(parents=True, exist_ok=True)
+        manifest = ExportManifest(args.dir, {
+            "indexed": args.indexed,
+            "atlas": args.atlas,
+            "atlas_size": args.atlas_size if args.atlas else None,
+            "trim": args.trim if args.atlas else None,
+        })
+
+        # Outputs of source files which have since been deleted
+        for key in manifest.missing_sources():
+            entry = manifest.sources.pop(key)
+            remove_outputs(entry["output_dir"], entry["outputs"])
+
+            try:
+                os.rmdir(entry["output_dir"])
+            except OSError:
+                pass
+
+    try:
+        file_paths = archives.expand(args.input)
+    except archives.ERRORS as e:
+        failed[args.input] = e
+        file_paths = []
+
+    for file_path in file_paths:
+        try:
+            if not archives.exists(file_path):
+                print(f"file not found: {file_path}")
+                continue
+        except archives.ERRORS as e:
+            failed[file_path] = e
             continue
 
-        path = Path(file_path)
-        base_name = path.stem
-        file_ext = path.suffix.lower()
+        base_name = sprite_base_name(file_path)
+        file_ext = Path(file_path).suffix.lower()
 
-        if file_ext == ".sft":
-            cls = FontFile
-        elif file_ext == ".spr":
-            cls = SpriteFile
-        else:
+        if get_sprite_class(file_path) is None:
             print(f"invalid file extension: {file_ext}")
             continue
 
         output_dir = os.path.join(args.dir, base_name)
+        indices = None
+
+        # Unchanged files are skipped before they are read
+        if manifest is not None:
+            try:
+                indices, stale, entries[file_path] = plan_export(file_path, output_dir, manifest, args.atlas)
+            except Exception as e:
+                failed[file_path] = e
+                continue
+
+            remove_outputs(output_dir, stale)
+
+            if not indices:
+                unchanged += 1
+                continue
+
+        try:
+            with metrics.source(file_path):
+                frame_count = load_sprite(file_path).frame_count
+        except Exception as e:
+            failed[file_path] = e
+            continue
+
+        if indices is None:
+            indices = list(range(frame_count))
 
         Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-        fh = open(file_path, mode="rb")
-        sprite = cls(fh)
-        pad = len(str(sprite.frame_count))
+        if dedup is not None:
+            output_paths = [os.path.join(output_dir, frame_file_name(x, frame_count)) for x in indices]
 
-        for x, frame in enumerate(sprite.frames):
-            print(f"exporting {base_name} frame {x+1} of {sprite.frame_count}")
-            pixels = frame.get_pixel_data(fh, palettes=sprite.palettes)
-            image = png.from_array(pixels, "RGBA")
-            output_path = os.path.join(output_dir, f"{x+1:>0{pad}}.png")
-            image.save(output_path)
+            try:
+                indices = dedup.filter(file_path, load_sprite(file_path), indices, output_paths)
+            except Exception as e:
+                failed[file_path] = e
+                continue
+
+        if args.atlas:
+            tasks[file_path] = [(export_atlas, file_path, output_dir, args.engine, args.atlas_size, args.trim)]
+        else:
+            tasks[file_path] = [
+                (export_frames, file_path, output_dir, indices[start:start + FRAMES_PER_TASK], args.engine, args.indexed)
+                for start in range(0, len(indices), FRAMES_PER_TASK)
+            ]
+
+    if args.jobs == 1:
+        for file_path, file_tasks in tasks.items():
+            try:
+                for func, *task in file_tasks:
+                    func(*task, verbose=True)
+            except Exception as e:
+                failed[file_path] = e
+    else:
+        initializer = enable_shared_cache if cache_bytes else None
+
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=initializer, initargs=(cache_bytes,)) as executor:
+            # When profiling, workers return their metrics along with each task's result
+            wrapper = (metrics.profiled,) if collector is not None else ()
+            futures = {
+                file_path: [executor.submit(*wrapper, *task) for task in file_tasks]
+                for file_path, file_tasks in tasks.items()
+            }
+
+            for file_path, file_futures in futures.items():
+                exported = 0
+
+                for future in file_futures:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        failed.setdefault(file_path, e)
+                        continue
+
+                    if collector is not None:
+                        result, snapshot = result
+                        collector.merge(snapshot)
+
+                    exported += result
 
-        fh.close()
+                if file_path not in failed:
+                    print(f"exported {sprite_base_name(file_path)} ({exported} frames)")
+
+    if dedup is not None:
+        report = dedup.apply(args.dir, failed)
+        print(
+            f"deduplicated {report['duplicate_frames']} of {report['frames']} frames,"
+            f" saving {report['saved_output_bytes']} bytes of output ({report['saved_decoded_bytes']} bytes decoded)"
+        )
+
+    for file_path, e in failed.items():
+        print(f"failed to export {file_path}: {e!r}")
+
+    if manifest is not None:
+        # Failed files are left out, so they are exported in full next time
+        for file_path, entry in entries.items():
+            if file_path in failed:
+                manifest.remove(file_path)
+                continue
+
+            if args.atlas and file_path in tasks:
+                entry["outputs"] = atlas_outputs(entry["output_dir"], sprite_base_name(file_path))
+
+            manifest.set(file_path, entry)
+
+        manifest.save()
+        print(f"{len(tasks)} exported, {unchanged} unchanged")
+
+    if cache_bytes and args.jobs == 1:
+        print("frame cache: " + ", ".join(f"{k}={v}" for k, v in get_shared_cache().stats.items()))
+
+    if collector is not None:
+        collector.save(args.profile)
+        print(f"saved metrics to {args.profile}")
+
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", required=True, help='file or folder path (e.g. "C:\\sprites\\*.spr")')
+    parser.add_argument("-i", "--input", required=True, help='file or folder path (e.g. "C:\\sprites\\*.spr"), an archive member (e.g. "assets.zip::Creatures/*.spr"), or - to read one sprite from stdin')
     parser.add_argument("-d", "--dir", required=True, help="output directory")
+    parser.add_argument("-e", "--engine", choices=("python", "numpy"), default="python", help="pixel decoder (numpy is much faster)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes (default: 1)")
+    parser.add_argument("--indexed", action="store_true", help="write 8-bit paletted PNGs instead of RGBA")
+    parser.add_argument("--atlas", action="store_true", help="pack each sprite's frames into texture atlas sheets with a JSON index")
+    parser.add_argument("--atlas-size", type=int, default=DEFAULT_SHEET_SIZE, help=f"maximum atlas sheet size (default: {DEFAULT_SHEET_SIZE})")
+    parser.add_argument("--trim", action="store_true", help="trim fully transparent borders before packing")
+    parser.add_argument("--incremental", action="store_true", help="only export frames which changed since the last run, using a manifest in the output directory")
+    parser.add_argument("--dedup", choices=(DEDUP_LINK, DEDUP_REFERENCE), help="export repeated frames once, hard linking duplicates or listing them in dedup.json")
+    parser.add_argument("--stdin-name", default="stdin", help="output subdirectory for a sprite read from stdin (default: stdin)")
+    parser.add_argument("--cache-mb", type=int, default=0, help="decoded frame cache size per process, in MiB (default: off)")
+    parser.add_argument("--profile", metavar="PATH", help="save per-stage timings and counters, with percentiles, to a JSON file")
     args = parser.parse_args()
-    main(args)
+
+    if args.indexed and args.atlas:
+        parser.error("--indexed can't be combined with --atlas")
+
+    if args.dedup and args.atlas:
+        parser.error("--dedup can't be combined with --atlas")
+
+    if args.dedup == DEDUP_REFERENCE and args.incremental:
+        parser.error("--dedup reference can't be combined with --incremental")
+
+    if args.input == "-" and (args.indexed or args.atlas):
+        parser.error("--indexed and --atlas aren't supported when reading from stdin")
+
+    sys.exit(main(args))
@@ -0,0 +1,158 @@
+import os
+import threading
+
+from collections import OrderedDict
+
+import metrics
+
+from archives import is_archive_path, member_identity
+
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def file_identity(file_path: str):
+    """
+    Identifies a file on disk (or in an archive), and changes whenever the file is modified or replaced.
+    """
+    if is_archive_path(file_path):
+        return member_identity(file_path)
+
+    stat = os.stat(file_path)
+    return (os.path.realpath(file_path), stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def pixels_size(pixels):
+    """
+    Approximate memory used by decoded pixel data (a NumPy array or a list of rows).
+    """
+    if hasattr(pixels, "nbytes"):
+        return pixels.nbytes
+
+    return sum(len(row) for row in pixels)
+
+
+class FrameCache:
+    """
+    LRU cache of decoded frames with a memory budget in bytes.
+
+    Keys are (file identity, frame index, palette index, engine); entries are evicted least recently used first
+    once the total size of cached frames exceeds `max_bytes`. Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            hit = key in self.entries
+
+            if hit:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                value = self.entries[key][0]
+            else:
+                self.misses += 1
+                value = default
+
+        metrics.count("cache_hits" if hit else "cache_misses")
+
+        return value
+
+    def put(self, key, value, size: int):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+            # Never worth evicting everything else for a single oversized entry
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    @property
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def get_pixels(self, file_path: str, sprite, index: int, engine: str = "python"):
+        """
+        Returns a frame's decoded pixels, decoding and caching them on a miss.
+
+        `sprite` must have been read from `file_path`; `engine` is "python" (`get_pixel_data`) or "numpy"
+        (`get_pixel_array`). The pixels are shared, so arrays are returned read-only and rows as bytes.
+        """
+        frame = sprite.frames[index]
+        key = (file_identity(file_path), index, frame.palette_index, engine)
+        pixels = self.get(key)
+
+        if pixels is None:
+            source = sprite.buffer if sprite.buffer is not None else open(file_path, mode="rb")
+
+            try:
+                if engine == "numpy":
+                    pixels = frame.get_pixel_array(source, palettes=sprite.palettes)
+                else:
+                    pixels = frame.get_pixel_data(source, palettes=sprite.palettes)
+            finally:
+                if source is not sprite.buffer:
+                    source.close()
+
+            if hasattr(pixels, "flags"):
+                pixels.flags.writeable = False
+            else:
+                pixels = [bytes(row) for row in pixels]
+
+            self.put(key, pixels, pixels_size(pixels))
+
+        return pixels
+
+
+shared_cache = None
+
+
+def enable_shared_cache(max_bytes: int = DEFAULT_MAX_BYTES):
+    """
+    Enables the process-wide cache returned by `get_shared_cache`.
+    """
+    global shared_cache
+
+    if shared_cache is None:
+        shared_cache = FrameCache(max_bytes)
+    else:
+        shared_cache.max_bytes = max_bytes
+
+    return shared_cache
+
+
+def get_shared_cache():
+    return shared_cache
@@ -0,0 +1,313 @@
+"""
+Local HTTP server for sprite frames, for asset browsers which render frames on demand.
+
+    py frame_server.py serve --root "C:\\Magic & Mayhem" --port 8000 --jobs 4
+
+    GET /sprite/<path>.json          sprite header and frame metadata
+    GET /sprite/<path>/<frame>.png   one frame (indexed from 0) as an RGBA PNG
+
+Paths are relative to the root directory. Responses carry an ETag derived from the file's modification time and
+size, so browsers can revalidate with If-None-Match. Parsed sprites and encoded PNGs are cached in each worker
+process and the server respectively; decoding and PNG encoding run in a process pool, so the event loop only
+ever moves bytes. Concurrent requests for the same frame share a single decode.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from urllib.parse import unquote
+
+import png
+
+from export_image import decode_frame, get_sprite_class
+from frame_cache import FrameCache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+DEFAULT_PORT = 8000
+
+MAX_HEADER_SIZE = 64 * 1024
+
+STATUS_TEXT = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+class NotFound(Exception):
+    pass
+
+
+@lru_cache(maxsize=32)
+def load_sprite(file_path: str, mtime_ns: int, size: int):
+    """
+    Worker-side sprite cache; the modification time and size are part of the key so changed files are re-read.
+    """
+    return get_sprite_class(file_path)(file_path, lazy=True)
+
+
+def sprite_metadata(file_path: str, mtime_ns: int, size: int):
+    sprite = load_sprite(file_path, mtime_ns, size)
+
+    return {
+        "file": os.path.basename(file_path),
+        "version": sprite.version,
+        "frame_count": sprite.frame_count,
+        "palette_count": sprite.palette_count,
+        "frames": [
+            {
+                "index": x,
+                "name": header.name,
+                "width": header.width,
+                "height": header.height,
+                "centre_x": header.centre_x,
+                "centre_y": header.centre_y,
+                "palette_index": header.palette_index,
+            }
+            for x, header in enumerate(sprite.frame_headers())
+        ],
+    }
+
+
+def frame_png(file_path: str, mtime_ns: int, size: int, index: int, engine: str):
+    sprite = load_sprite(file_path, mtime_ns, size)
+
+    if not 0 <= index < sprite.frame_count:
+        raise NotFound(f"frame {index} out of range")
+
+    frame = sprite.frames[index]
+
+    if not frame.has_valid_dimensions:
+        raise NotFound(f"frame {index} is empty")
+
+    pixels = decode_frame(file_path, sprite, index, engine)
+    output = io.BytesIO()
+    png.Writer(frame.width, frame.height, greyscale=False, alpha=True).write(output, pixels)
+
+    return output.getvalue()
+
+
+class FrameServer:
+    def __init__(self, root: str, executor, engine: str = "python", cache_bytes: int = 64 * 1024 * 1024):
+        self.root = os.path.realpath(root)
+        self.executor = executor
+        self.engine = engine
+        self.cache = FrameCache(cache_bytes)
+        self.pending = {}
+
+    def resolve(self, relative_path: str):
+        """
+        Maps a request path to a sprite below the root, refusing anything outside it.
+        """
+        file_path = os.path.realpath(os.path.join(self.root, relative_path))
+
+        if os.path.commonpath((self.root, file_path)) != self.root or get_sprite_class(file_path) is None:
+            raise NotFound(relative_path)
+
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            raise NotFound(relative_path)
+
+        return file_path, stat.st_mtime_ns, stat.st_size
+
+    async def cached(self, key, func, *args):
+        """
+        Returns a cached result, or runs `func` in the executor; concurrent calls with the same key share one run.
+        """
+        result = self.cache.get(key)
+
+        if result is not None:
+            return result
+
+        if key not in self.pending:
+            loop = asyncio.get_running_loop()
+            self.pending[key] = loop.run_in_executor(self.executor, func, *args)
+
+        future = self.pending[key]
+
+        try:
+            result = await asyncio.shield(future)
+        finally:
+            if future.done():
+                self.pending.pop(key, None)
+
+        self.cache.put(key, result, len(result))
+
+        return result
+
+    def route(self, path: str):
+        """
+        Returns the content type and ETag of a request path, and the cache key, function and arguments which
+        produce its body; the body is only produced if the client doesn't already have it.
+        """
+        path = unquote(path.split("?", 1)[0])
+
+        if not path.startswith("/sprite/"):
+            raise NotFound(path)
+
+        path = path[len("/sprite/"):]
+
+        if path.endswith(".json"):
+            file_path, mtime_ns, size = self.resolve(path[:-len(".json")])
+            etag = f'"{mtime_ns:x}-{size:x}"'
+            key = (file_path, mtime_ns, size, "json")
+
+            return "application/json", etag, key, self.metadata_json, (file_path, mtime_ns, size)
+
+        sprite_path, _, frame_name = path.rpartition("/")
+
+        if not frame_name.endswith(".png") or not frame_name[:-len(".png")].isdigit():
+            raise NotFound(path)
+
+        index = int(frame_name[:-len(".png")])
+        file_path, mtime_ns, size = self.resolve(sprite_path)
+        etag = f'"{mtime_ns:x}-{size:x}-{index}"'
+        key = (file_path, mtime_ns, size, index, self.engine)
+
+        return "image/png", etag, key, frame_png, (file_path, mtime_ns, size, index, self.engine)
+
+    @staticmethod
+    def metadata_json(file_path: str, mtime_ns: int, size: int):
+        return json.dumps(sprite_metadata(file_path, mtime_ns, size)).encode()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+
+                lines = head.decode("latin-1").split("\r\n")
+                parts = lines[0].split()
+                headers = {}
+
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = (
+                    len(parts) == 3
+                    and parts[2] == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+
+                if len(parts) != 3:
+                    await self.respond(writer, 400, b"bad request\n", keep_alive=False)
+                    break
+
+                method, path, _ = parts
+
+                if method not in ("GET", "HEAD"):
+                    await self.respond(writer, 405, b"method not allowed\n", keep_alive=keep_alive)
+                elif "content-length" in headers or "transfer-encoding" in headers:
+                    await self.respond(writer, 400, b"request bodies aren't supported\n", keep_alive=False)
+                    break
+                else:
+                    await self.respond_to(writer, method, path, headers, keep_alive)
+
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond_to(self, writer, method: str, path: str, headers: dict, keep_alive: bool):
+        try:
+            content_type, etag, key, func, args = self.route(path)
+
+            if etag in (tag.strip() for tag in headers.get("if-none-match", "").split(",")):
+                await self.respond(writer, 304, b"", etag=etag, keep_alive=keep_alive)
+                return
+
+            body = await self.cached(key, func, *args)
+        except NotFound as e:
+            await self.respond(writer, 404, f"not found: {e}\n".encode(), keep_alive=keep_alive)
+            return
+        except Exception as e:
+            await self.respond(writer, 500, f"{e!r}\n".encode(), keep_alive=keep_alive)
+            return
+
+        await self.respond(writer, 200, body, content_type, etag, keep_alive, head_only=method == "HEAD")
+
+    async def respond(self, writer, status: int, body: bytes, content_type: str = "text/plain", etag: str = None, keep_alive: bool = True, head_only: bool = False):
+        lines = [
+            f"HTTP/1.1 {status} {STATUS_TEXT[status]}",
+            f"Content-Length: {len(body) if status != 304 else 0}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+
+        if status != 304:
+            lines.append(f"Content-Type: {content_type}")
+
+        if etag is not None:
+            lines.append(f"ETag: {etag}")
+            lines.append("Cache-Control: no-cache")
+
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+        if status != 304 and not head_only:
+            writer.write(body)
+
+        await writer.drain()
+
+
+async def serve(root: str, host: str, port: int, jobs: int, engine: str, cache_bytes: int):
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        server = FrameServer(root, executor, engine, cache_bytes)
+        tcp_server = await asyncio.start_server(server.handle, host, port, limit=MAX_HEADER_SIZE)
+
+        print(f"serving {server.root} on http://{host}:{port}/sprite/")
+
+        async with tcp_server:
+            await tcp_server.serve_forever()
+
+
+def serve_command(args: argparse.Namespace):
+    if not os.path.isdir(args.root):
+        print(f"not a directory: {args.root}")
+        return 1
+
+    if args.engine == "numpy" and np is None:
+        print("the numpy engine requires numpy")
+        return 1
+
+    try:
+        asyncio.run(serve(args.root, args.host, args.port, args.jobs, args.engine, args.cache_mb * 1024 * 1024))
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="serve sprite frames over HTTP")
+    serve_parser.add_argument("--root", required=True, help="game directory to serve sprites from")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"port to listen on (default: {DEFAULT_PORT})")
+    serve_parser.add_argument("-j", "--jobs", type=int, default=None, help="number of decoding processes (default: all cores)")
+    serve_parser.add_argument("-e", "--engine", choices=("python", "numpy"), default="python", help="pixel decoder (numpy is much faster)")
+    serve_parser.add_argument("--cache-mb", type=int, default=64, help="encoded frame cache size, in MiB (default: 64)")
+    serve_parser.set_defaults(func=serve_command)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,147 @@
+"""
+Export manifest, for incremental exports.
+
+The manifest records each source file's size, modification time and hash, and a hash of every frame's raw
+(run-length encoded) bytes and palette, along with the file each frame was exported to. A later run only exports
+frames whose inputs have changed, and removes outputs which are no longer produced.
+"""
+
+import hashlib
+import json
+import os
+import struct
+
+import archives
+
+
+MANIFEST_NAME = "export_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def source_key(file_path: str):
+    """
+    Stable manifest key for a file path or archive member, independent of the working directory.
+    """
+    archive, member = archives.split_path(file_path)
+
+    if archive is not None:
+        return f"{os.path.abspath(archive)}{archives.SEPARATOR}{member}"
+
+    return os.path.abspath(file_path)
+
+
+def source_stat(file_path: str):
+    """
+    [size, modification time] of a file, or of the archive containing it.
+    """
+    archive, _ = archives.split_path(file_path)
+    stat = os.stat(archive if archive is not None else file_path)
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def hash_file(file_path: str):
+    if archives.is_archive_path(file_path):
+        return hashlib.sha256(archives.read_member(file_path)).hexdigest()
+
+    digest = hashlib.sha256()
+
+    with open(file_path, mode="rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def hash_frame(sprite, index: int):
+    """
+    Hash of everything a frame's output depends on: its raw bytes and its palette.
+    """
+    frame = sprite.frames[index]
+    digest = hashlib.sha256(frame.read_data(sprite.buffer))
+    digest.update(frame.get_palette(sprite.palettes).rgba)
+
+    return digest.hexdigest()
+
+
+def hash_pixels(sprite, index: int):
+    """
+    Hash of a frame's image alone: its dimensions, row table, delta and pixel data, and palette. Unlike
+    `hash_frame`, frames which only differ by name, centre or header version hash the same.
+    """
+    frame = sprite.frames[index]
+    data = frame.read_data(sprite.buffer)
+    start = frame.delta_offsets[0] if frame.height else frame.size
+
+    # Row offsets are relative to the frame header, whose size depends on the sprite version
+    rows = [offset - start for pair in zip(frame.delta_offsets, frame.pixel_offsets) for offset in pair]
+
+    digest = hashlib.sha256(struct.pack(f"<2I{len(rows)}i", frame.width, frame.height, *rows))
+    digest.update(data[start:])
+    digest.update(frame.get_palette(sprite.palettes).rgba)
+
+    return digest.hexdigest()
+
+
+class ExportManifest:
+    """
+    `sources` maps each source key to a dict of its "stat", "hash", "output_dir", "frames" (each frame's hash)
+    and "outputs" (the files written to the output directory; one per frame unless exported as an atlas).
+    """
+
+    def __init__(self, output_dir: str, options: dict):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.options = options
+        self.sources = {}
+
+        try:
+            with open(self.path) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return
+
+        # Outputs written with different options have to be exported again
+        if data.get("version") == MANIFEST_VERSION and data.get("options") == options:
+            self.sources = data["sources"]
+
+    def get(self, file_path: str):
+        return self.sources.get(source_key(file_path))
+
+    def set(self, file_path: str, entry: dict):
+        self.sources[source_key(file_path)] = entry
+
+    def remove(self, file_path: str):
+        return self.sources.pop(source_key(file_path), None)
+
+    def save(self):
+        data = {
+            "version": MANIFEST_VERSION,
+            "options": self.options,
+            "sources": self.sources,
+        }
+
+        # Written in full then renamed, so an interrupted run never leaves a truncated manifest
+        temp_path = self.path + ".tmp"
+
+        with open(temp_path, mode="w") as fh:
+            json.dump(data, fh, indent=1)
+
+        os.replace(temp_path, self.path)
+
+    def missing_sources(self):
+        """
+        Source files in the manifest which no longer exist.
+        """
+        return [key for key in self.sources if not archives.exists(key)]
+
+
+def outputs_exist(entry: dict):
+    return all(os.path.exists(os.path.join(entry["output_dir"], name)) for name in entry["outputs"])
+
+
+def remove_outputs(output_dir: str, names):
+    for name in names:
+        try:
+            os.remove(os.path.join(output_dir, name))
+        except FileNotFoundError:
+            pass
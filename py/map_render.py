@@ -0,0 +1,280 @@
+"""
+Renders .map segments layer by layer from their realm's Terrain.spr (and optionally Terrain.ttd).
+
+    py map_render.py -m CFsec50.map -s Terrain.spr -t Terrain.ttd -d out --jobs 8
+
+The exact screen projection used by the game is undocumented, so tiles are placed on an isometric grid whose
+size can be adjusted; each frame is centred on its tile's anchor point and offset by its `centre_x`/`centre_y`.
+"""
+
+import argparse
+import os
+import sys
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from glob import glob
+from pathlib import Path
+
+import numpy as np
+import png
+
+from frame_cache import FrameCache, get_shared_cache
+from mm_files import MapFile, SpriteFile, TerrainTypeFile
+
+
+@dataclass(frozen=True)
+class Projection:
+    tile_width: int = 64
+    tile_height: int = 32
+    layer_height: int = 32
+    isometric: bool = True
+
+    def anchors(self, x, y, z):
+        """
+        Screen position of tile coordinates (arrays or scalars).
+        """
+        if self.isometric:
+            screen_x = (x - y) * (self.tile_width // 2)
+            screen_y = (x + y) * (self.tile_height // 2) - z * self.layer_height
+        else:
+            screen_x = x * self.tile_width
+            screen_y = y * self.tile_height - z * self.layer_height
+
+        return screen_x, screen_y
+
+
+@lru_cache(maxsize=8)
+def load_map(map_path: str, encrypted: bool = False):
+    return MapFile.from_encrypted(map_path) if encrypted else MapFile(map_path)
+
+
+@lru_cache(maxsize=4)
+def load_terrain(sprite_path: str):
+    return SpriteFile(sprite_path, lazy=True)
+
+
+@lru_cache(maxsize=4)
+def load_terrain_types(ttd_path: str):
+    return TerrainTypeFile(ttd_path)
+
+
+class MapRenderer:
+    def __init__(self, map_file: MapFile, sprite_path: str, terrain_types: TerrainTypeFile = None, projection: Projection = Projection()):
+        self.map_file = map_file
+        self.sprite_path = sprite_path
+        self.sprite = load_terrain(sprite_path)
+        self.projection = projection
+        self.cache = get_shared_cache() or FrameCache()
+        self.tiles = {}
+
+        tile_count = self.sprite.frame_count
+
+        if terrain_types is not None:
+            tile_count = min(tile_count, terrain_types.tile_count)
+
+        terrain = self.map_file.terrain_indices
+        z, y, x = np.nonzero((terrain >= 0) & (terrain < tile_count))
+        indices = terrain[z, y, x].astype(np.int64)
+
+        # Only frames used by the map are ever parsed
+        used = np.unique(indices)
+        frames = {int(index): self.sprite.frames[index] for index in used}
+        drawable = np.array([frames[int(index)].has_valid_dimensions for index in indices], dtype=bool)
+
+        self.z, self.y, self.x, self.indices = z[drawable], y[drawable], x[drawable], indices[drawable]
+        self.frames = frames
+
+        widths = np.array([frames[int(index)].width for index in self.indices], dtype=np.int64)
+        heights = np.array([frames[int(index)].height for index in self.indices], dtype=np.int64)
+        centre_x = np.array([frames[int(index)].centre_x for index in self.indices], dtype=np.int64)
+        centre_y = np.array([frames[int(index)].centre_y for index in self.indices], dtype=np.int64)
+
+        anchor_x, anchor_y = projection.anchors(self.x, self.y, self.z)
+        self.left = anchor_x - widths // 2 + centre_x
+        self.top = anchor_y - heights // 2 + centre_y
+
+        if self.indices.size:
+            self.origin = (int(self.left.min()), int(self.top.min()))
+            self.size = (int((self.left + widths).max()) - self.origin[0], int((self.top + heights).max()) - self.origin[1])
+        else:
+            self.origin = (0, 0)
+            self.size = (1, 1)
+
+    def tile(self, index: int):
+        # The local dict skips the shared cache's per-lookup file_identity stat for tiles already drawn
+        pixels = self.tiles.get(index)
+
+        if pixels is None:
+            pixels = self.tiles[index] = self.cache.get_pixels(self.sprite_path, self.sprite, index, engine="numpy")
+
+        return pixels
+
+    def render_layer(self, z: int, canvas=None):
+        """
+        Draws one layer back to front, onto `canvas` if given; every layer shares the same canvas size.
+        """
+        if canvas is None:
+            canvas = np.zeros((self.size[1], self.size[0], 4), dtype=np.uint8)
+
+        in_layer = np.flatnonzero(self.z == z)
+        order = in_layer[np.lexsort((self.x[in_layer], self.y[in_layer] + self.x[in_layer]))]
+
+        for x in order:
+            pixels = self.tile(int(self.indices[x]))
+            left = int(self.left[x]) - self.origin[0]
+            top = int(self.top[x]) - self.origin[1]
+            region = canvas[top:top + pixels.shape[0], left:left + pixels.shape[1]]
+            opaque = pixels[:, :, 3] > 0
+            region[opaque] = pixels[opaque]
+
+        return canvas
+
+    def render(self):
+        """
+        Composites every layer, from the ground upwards.
+        """
+        canvas = None
+
+        for z in range(self.map_file.size_z):
+            canvas = self.render_layer(z, canvas)
+
+        return canvas
+
+
+def overlay(canvas, layer):
+    """
+    Draws a layer's opaque pixels over `canvas`, in place.
+    """
+    opaque = layer[:, :, 3] > 0
+    canvas[opaque] = layer[opaque]
+
+    return canvas
+
+
+def composite(layers: list):
+    canvas = layers[0].copy()
+
+    for layer in layers[1:]:
+        overlay(canvas, layer)
+
+    return canvas
+
+
+def save_png(pixels, output_path: str):
+    height, width = pixels.shape[:2]
+
+    with open(output_path, mode="wb") as fh:
+        png.Writer(width, height, greyscale=False, alpha=True).write(fh, pixels.reshape(height, width * 4))
+
+
+@lru_cache(maxsize=2)
+def load_renderer(map_path: str, sprite_path: str, ttd_path: str, projection: Projection, encrypted: bool):
+    """
+    Worker-side renderer cache, so each worker only sets up a map's renderer once.
+    """
+    terrain_types = load_terrain_types(ttd_path) if ttd_path else None
+    return MapRenderer(load_map(map_path, encrypted), sprite_path, terrain_types, projection)
+
+
+def render_layers_task(map_path: str, sprite_path: str, ttd_path: str, output_dir: str, layers: range, projection: Projection, encrypted: bool):
+    """
+    Renders and saves a range of a map's layers. Returns the range's layers composited together, so only one
+    canvas per task is sent back for the map's composite image.
+    """
+    renderer = load_renderer(map_path, sprite_path, ttd_path, projection, encrypted)
+    base_name = Path(map_path).stem
+    canvas = None
+
+    for z in layers:
+        layer = renderer.render_layer(z)
+        save_png(layer, os.path.join(output_dir, f"{base_name}_z{z:02}.png"))
+        canvas = layer if canvas is None else overlay(canvas, layer)
+
+    return canvas
+
+
+def split_layers(size_z: int, parts: int):
+    """
+    Splits a map's layers into up to `parts` contiguous ranges, in order.
+    """
+    parts = max(1, min(size_z, parts))
+    bounds = [size_z * x // parts for x in range(parts + 1)]
+
+    return [range(start, stop) for start, stop in zip(bounds, bounds[1:])]
+
+
+def render_maps(map_paths: list, sprite_path: str, ttd_path: str, output_dir: str, projection: Projection = Projection(), encrypted: bool = False, jobs: int = None):
+    """
+    Renders every layer of every map across a process pool, writing `<map>_z<layer>.png` for each layer plus a
+    composite `<map>.png`. Returns a dict of map path to None, or the exception raised for that map.
+
+    Each map's layers are split into one contiguous range per worker; workers save their layers themselves and
+    only return their range's composite. At most two maps are in flight at once, so the next map is rendered while
+    the previous one's composite is saved, without finished layers piling up in memory.
+    """
+    results = {}
+    workers = jobs or os.cpu_count() or 1
+    in_flight = deque()
+
+    def finish(map_path: str, futures: list):
+        try:
+            canvases = [canvas for canvas in (future.result() for future in futures) if canvas is not None]
+            save_png(composite(canvases), os.path.join(output_dir, f"{Path(map_path).stem}.png"))
+            results[map_path] = None
+        except Exception as e:
+            results[map_path] = e
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for map_path in map_paths:
+            try:
+                size_z = load_map(map_path, encrypted).size_z
+            except Exception as e:
+                results[map_path] = e
+                continue
+
+            if len(in_flight) == 2:
+                finish(*in_flight.popleft())
+
+            in_flight.append((map_path, [
+                executor.submit(render_layers_task, map_path, sprite_path, ttd_path, output_dir, layers, projection, encrypted)
+                for layers in split_layers(size_z, workers)
+            ]))
+
+        while in_flight:
+            finish(*in_flight.popleft())
+
+    return results
+
+
+def main(args: argparse.Namespace):
+    Path(args.dir).mkdir(parents=True, exist_ok=True)
+
+    projection = Projection(args.tile_width, args.tile_height, args.layer_height, not args.flat)
+    results = render_maps(sorted(glob(args.map)), args.sprite, args.ttd, args.dir, projection, args.encrypted, args.jobs)
+
+    for map_path, result in results.items():
+        if result is None:
+            print(f"rendered {map_path}")
+        else:
+            print(f"failed to render {map_path}: {result!r}")
+
+    return 1 if any(result is not None for result in results.values()) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--map", required=True, help='decrypted .map file(s) (e.g. "CFsec*.map")')
+    parser.add_argument("-s", "--sprite", required=True, help="the realm's Terrain.spr")
+    parser.add_argument("-t", "--ttd", help="the realm's Terrain.ttd")
+    parser.add_argument("-d", "--dir", required=True, help="output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--encrypted", action="store_true", help="decrypt the maps with mm_decrypt first")
+    parser.add_argument("--tile-width", type=int, default=Projection.tile_width)
+    parser.add_argument("--tile-height", type=int, default=Projection.tile_height)
+    parser.add_argument("--layer-height", type=int, default=Projection.layer_height)
+    parser.add_argument("--flat", action="store_true", help="use a top-down grid instead of an isometric one")
+    args = parser.parse_args()
+    sys.exit(main(args))
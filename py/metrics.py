@@ -0,0 +1,224 @@
+"""
+Optional instrumentation for the sprite pipeline: stage timings and counters, attributed to source files.
+
+Collection is off until `enable()` is called; until then `timer()` and `count()` do nothing. Stages are:
+
+    verify, parse_header, parse_data    reading a file (MMFile)
+    decode                              decoding a frame's pixels or indices
+    encode_png, write, pack             PNG encoding, writing to disk and atlas packing (export_image.py)
+    read, decode_rows, write_rows, save reading, converting and saving a file (mm-to-excel.py)
+
+and counters include bytes_read, frames_decoded, pixels_decoded, rows, cache_hits and cache_misses. Stages may nest
+(e.g. decode runs within a frame cache lookup), so their times needn't add up to the total.
+
+    import metrics
+
+    collector = metrics.enable()
+    collector.add_callback(lambda kind, name, value, source: print(kind, name, value, source))
+    ...
+    collector.save("metrics.json")
+
+Callbacks are called in the process which records each event; process pools return their workers' metrics
+with `profiled` and combine them with `Metrics.merge`.
+"""
+
+import json
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(values: list, p: int):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    rank = max(0, -(-p * len(values) // 100) - 1)
+    return values[rank]
+
+
+def describe(values: list):
+    values = sorted(values)
+
+    if not values:
+        return {"count": 0}
+
+    return {
+        "count": len(values),
+        "total": sum(values),
+        "mean": sum(values) / len(values),
+        "min": values[0],
+        "max": values[-1],
+        **{f"p{p}": percentile(values, p) for p in PERCENTILES},
+    }
+
+
+class Metrics:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.callbacks = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @property
+    def current_source(self):
+        return getattr(self.local, "source", None)
+
+    def add_callback(self, callback):
+        """
+        `callback(kind, name, value, source)` is called for every event: kind is "timing" (value in seconds)
+        or "count", and source the file being processed, if any.
+        """
+        self.callbacks.append(callback)
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+            self.counters.clear()
+
+    def record(self, stage: str, seconds: float):
+        source = self.current_source
+
+        with self.lock:
+            self.timings[(source, stage)].append(seconds)
+
+        for callback in self.callbacks:
+            callback("timing", stage, seconds, source)
+
+    def count(self, name: str, value: int = 1):
+        source = self.current_source
+
+        with self.lock:
+            self.counters[(source, name)] += value
+
+        for callback in self.callbacks:
+            callback("count", name, value, source)
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def source(self, file_path: str):
+        """
+        Attributes everything recorded within the block (on this thread) to `file_path`, and times it as "file".
+        """
+        previous = self.current_source
+        self.local.source = file_path
+
+        try:
+            with self.timer("file"):
+                yield
+        finally:
+            self.local.source = previous
+
+    def snapshot(self):
+        """
+        Raw measurements, as plain lists which can be pickled or saved.
+        """
+        with self.lock:
+            return {
+                "timings": [[source, stage, list(values)] for (source, stage), values in self.timings.items()],
+                "counters": [[source, name, value] for (source, name), value in self.counters.items()],
+            }
+
+    def merge(self, snapshot: dict):
+        with self.lock:
+            for source, stage, values in snapshot["timings"]:
+                self.timings[(source, stage)].extend(values)
+
+            for source, name, value in snapshot["counters"]:
+                self.counters[(source, name)] += value
+
+    def summary(self):
+        """
+        Percentiles of every stage, across individual events ("stages") and across per-file totals ("per_file"),
+        counter totals, and each file's stage totals and counters.
+        """
+        stages = defaultdict(list)
+        file_totals = defaultdict(lambda: defaultdict(float))
+        counters = defaultdict(int)
+        files = defaultdict(lambda: {"stages": {}, "counters": {}})
+
+        with self.lock:
+            for (source, stage), values in self.timings.items():
+                stages[stage].extend(values)
+
+                if source is not None:
+                    file_totals[stage][source] += sum(values)
+                    files[source]["stages"][stage] = sum(values)
+
+            for (source, name), value in self.counters.items():
+                counters[name] += value
+
+                if source is not None:
+                    files[source]["counters"][name] = value
+
+        return {
+            "stages": {stage: describe(values) for stage, values in sorted(stages.items())},
+            "per_file": {stage: describe(list(totals.values())) for stage, totals in sorted(file_totals.items())},
+            "counters": dict(sorted(counters.items())),
+            "files": dict(sorted(files.items())),
+        }
+
+    def save(self, path: str):
+        with open(path, mode="w") as fh:
+            json.dump(self.summary(), fh, indent=1)
+
+
+collector = None
+
+
+def enable():
+    """
+    Starts collecting metrics in this process, returning the collector.
+    """
+    global collector
+
+    if collector is None:
+        collector = Metrics()
+
+    return collector
+
+
+def disable():
+    global collector
+    collector = None
+
+
+def get():
+    return collector
+
+
+def timer(stage: str):
+    return collector.timer(stage) if collector is not None else nullcontext()
+
+
+def count(name: str, value: int = 1):
+    if collector is not None:
+        collector.count(name, value)
+
+
+def source(file_path: str):
+    return collector.source(file_path) if collector is not None else nullcontext()
+
+
+def profiled(func, *args, **kwargs):
+    """
+    Process pool wrapper: runs `func` with metrics enabled, and returns its result along with a snapshot of the
+    metrics recorded while it ran.
+    """
+    enable().reset()
+    result = func(*args, **kwargs)
+
+    return result, collector.snapshot()
@@ -0,0 +1,283 @@
+"""
+Decryption and unpacking of .map and .cfg files; a port of Nikita Sadkov's c/mmdecrypt.c.
+
+Output is byte-identical to the C routine's. Usage:
+
+    py mm_decrypt.py CFsec02.map CFsec02.dec.map
+    py mm_decrypt.py "Magic & Mayhem\\Realms" realms_decrypted --jobs 8
+"""
+
+import argparse
+import os
+import struct
+import sys
+import warnings
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from pathlib import Path
+
+
+COMP_PLAIN = 0
+COMP_RLE = 1
+COMP_LZ77 = 2
+
+HEADER = struct.Struct("<5I")
+
+LZ_DICT_SIZE = 4096
+
+DEFAULT_PATTERNS = ("*.map", "*.cfg")
+
+# PRNG state transitions; the table's two indices cycle through 0-249
+PRNG_MAP = [x + 1 for x in range(0xF9)] + [0] * (256 - 0xF9)
+
+BYTE_BITS = [format(x, "08b") for x in range(256)]
+
+
+class InvalidFile(Exception):
+    pass
+
+
+class UnsupportedCompression(Exception):
+    pass
+
+
+class ChecksumWarning(UserWarning):
+    pass
+
+
+def prng_init(table: list, seed: int):
+    state = seed
+    table[0] = 0
+    table[1] = 103
+
+    for x in range(251, 1, -1):
+        t = (0x41C64E6D * state) & 0xFFFFFFFFFFFFFFFF
+        t = ((((t >> 32) << 16) & 0xFFFFFFFF) << 32) | (t & 0xFFFFFFFF)
+        t = (t + 0xFFFF00003039) & 0xFFFFFFFFFFFFFFFF
+        state = t & 0xFFFFFFFF
+        table[x] = ((t >> 32) & 0xFFFF0000) | (state >> 16)
+
+    mask = 0xFFFFFFFF
+    bit = 0x80000000
+
+    for x in range(5, 5 + 7 * 32, 7):
+        table[x] = bit | (mask & table[x])
+        bit >>= 1
+        mask >>= 1
+
+
+def keystream(table: list, count: int):
+    """
+    Returns the next `count` values of the PRNG as a list.
+    """
+    values = [0] * count
+    prng_map = PRNG_MAP
+    a = table[0]
+    b = table[1]
+
+    for x in range(count):
+        c = table[b + 2] ^ table[a + 2]
+        table[a + 2] = c
+        values[x] = c
+        a = prng_map[a]
+        b = prng_map[b]
+
+    table[0] = a
+    table[1] = b
+
+    return values
+
+
+def decrypt(data: bytes):
+    """
+    Decrypts a whole file (header included); the first 4 bytes are the unencrypted seed.
+    """
+    data = bytearray(data)
+    table = [0] * 256
+
+    prng_init(table, 1234567890)
+    table[254] = 0
+    prng_init(table, struct.unpack_from("<I", data)[0])
+
+    word_count = (len(data) - 4) // 4
+    end = 4 + word_count * 4
+
+    words = array("I", keystream(table, word_count))
+
+    if sys.byteorder == "big":
+        words.byteswap()
+
+    body = int.from_bytes(data[4:end], "little") ^ int.from_bytes(words.tobytes(), "little")
+    data[4:end] = body.to_bytes(end - 4, "little")
+
+    # Trailing bytes are all XORed into the same byte, as in the C routine
+    for value in keystream(table, (len(data) - 4) % 4):
+        data[end] ^= value & 0xFF
+
+    return data
+
+
+def checksum(data: bytes):
+    words = array("I", bytes(data[:len(data) // 4 * 4]))
+
+    if sys.byteorder == "big":
+        words.byteswap()
+
+    total = 0
+
+    for x, word in enumerate(words):
+        if x & 1:
+            total = (total + word) & 0xFFFFFFFF
+        else:
+            total ^= word
+
+    return total
+
+
+def lz_unpack(data: bytes, unpacked_size: int):
+    """
+    Decompresses an LZ77 stream (4096 byte dictionary, 12-bit offsets and 4-bit lengths) into a preallocated buffer.
+    """
+    output = bytearray(unpacked_size)
+    lz_dict = bytearray(LZ_DICT_SIZE)
+    dict_index = 1
+    count = 0
+
+    # Trailing zero bits decode as a terminating back reference if the stream ends early
+    bits = "".join(map(BYTE_BITS.__getitem__, data)) + "0" * 13
+    pos = 0
+
+    while count < unpacked_size:
+        if bits[pos] == "1":
+            value = int(bits[pos + 1:pos + 9], 2)
+            pos += 9
+
+            output[count] = value
+            count += 1
+            lz_dict[dict_index] = value
+            dict_index = (dict_index + 1) & 0xFFF
+            continue
+
+        offset = int(bits[pos + 1:pos + 13], 2)
+        pos += 13
+
+        if not offset:
+            break
+
+        length = int(bits[pos:pos + 4] or "0", 2) + 2
+        pos += 4
+
+        for x in range(length):
+            value = lz_dict[(offset + x) & 0xFFF]
+            output[count] = value
+            count += 1
+
+            if count == unpacked_size:
+                break
+
+            lz_dict[dict_index] = value
+            dict_index = (dict_index + 1) & 0xFFF
+
+    return output
+
+
+def unpack(data: bytes):
+    """
+    Decrypts and decompresses the contents of an encrypted .map or .cfg file.
+    Checksum mismatches are reported as `ChecksumWarning`s, and handled in the same way as the C routine.
+    """
+    if len(data) <= HEADER.size:
+        raise InvalidFile(f"file is too small ({len(data)} bytes)")
+
+    data = decrypt(data)
+    seed, unpacked_size, checksum_1, checksum_2, compression = HEADER.unpack_from(data)
+    body = memoryview(data)[HEADER.size:]
+
+    if checksum_1 != checksum(body):
+        warnings.warn("bad checksum for decrypted data", ChecksumWarning)
+        unpacked_size = len(data)
+
+    if compression == COMP_PLAIN:
+        output = bytearray(body[:unpacked_size])
+        output.extend(bytes(unpacked_size - len(output)))
+    elif compression == COMP_LZ77:
+        output = lz_unpack(body, unpacked_size)
+    elif compression == COMP_RLE:
+        # mmdecrypt.c recognises RLE but has no decoder for it
+        raise UnsupportedCompression("RLE compression is not supported")
+    else:
+        raise UnsupportedCompression(f"unknown compression type ({compression:x})")
+
+    if checksum_2 != checksum(output):
+        warnings.warn("bad checksum for decompressed data", ChecksumWarning)
+
+    return bytes(output)
+
+
+def unpack_file(input_path: str, output_path: str):
+    with open(input_path, mode="rb") as fh:
+        data = unpack(fh.read())
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(output_path, mode="wb") as fh:
+        fh.write(data)
+
+    return len(data)
+
+
+def unpack_directory(input_dir: str, output_dir: str, patterns: tuple = DEFAULT_PATTERNS, jobs: int = None):
+    """
+    Unpacks every matching file below `input_dir` into the same relative path below `output_dir`, using a
+    process pool. Returns a dict of input path to unpacked size, or the exception raised for that file.
+    """
+    paths = sorted(
+        os.path.join(root, name)
+        for root, dirs, files in os.walk(input_dir)
+        for name in files
+        if any(fnmatch(name.lower(), pattern) for pattern in patterns)
+    )
+
+    results = {}
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            path: executor.submit(unpack_file, path, os.path.join(output_dir, os.path.relpath(path, input_dir)))
+            for path in paths
+        }
+
+        for path, future in futures.items():
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                results[path] = e
+
+    return results
+
+
+def main(args: argparse.Namespace):
+    if not os.path.isdir(args.input):
+        unpack_file(args.input, args.output)
+        return 0
+
+    failed = 0
+
+    for path, result in unpack_directory(args.input, args.output, jobs=args.jobs).items():
+        if isinstance(result, Exception):
+            print(f"failed to unpack {path}: {result!r}")
+            failed += 1
+        else:
+            print(f"unpacked {path} ({result} bytes)")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="encrypted file, or a directory to unpack every .map and .cfg file below")
+    parser.add_argument("output", help="output file, or directory when the input is a directory")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: all cores)")
+    args = parser.parse_args()
+    sys.exit(main(args))
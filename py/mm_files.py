@@ -1,25 +1,102 @@
 import os
+import struct
 
-from typing import BinaryIO
+from typing import BinaryIO, NamedTuple
 
 from base_classes import (
+    FILE_HEADER,
+    FRAME_HEADER,
     Frame,
-    GreyscalePalette,
+    FrameHeader,
+    FrameTable,
+    GREYSCALE_PALETTE,
+    InvalidFileSize,
+    InvalidSignature,
     MMFile,
     Palette,
     PALETTE_SIZE,
 )
-from utils import uint32
+from utils import read_exactly, skip, uint32
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+ANI_HEADER = struct.Struct("<4s5I20s")
+ANI_FRAME = struct.Struct("<I3i8s4b4i")
+
+ANI_FRAME_TYPE_SPRITE = 0
+
+MAP_HEADER = struct.Struct("<8I11i")
+
+# Field names follow MapTile in formats.md
+MAP_TILE_FIELDS = ("terrain_index", "unknown_1", "unknown_2", "unknown_3", "unknown_4", "unknown_5")
+MAP_TILE_DTYPE = np.dtype([(name, "<i2") for name in MAP_TILE_FIELDS]) if np is not None else None
+
+# Terrain type records are 356 bytes; their layout is undocumented, so they are decoded as 89 DWORDs
+TERRAIN_TYPE_SIZE = 356
+TERRAIN_TYPE_FIELDS = TERRAIN_TYPE_SIZE // 4
+
+
+class AniFrame(NamedTuple):
+    frame_type: int
+    frame_data: int
+    unknown_1: int
+    unknown_2: int
+    data: bytes
+    unknown_3: int
+    unknown_4: int
+    unknown_5: int
+    unknown_6: int
+    unknown_7: int
+    unknown_8: int
+    unknown_9: int
+    unknown_10: int
+
+    @property
+    def is_sprite(self):
+        return self.frame_type == ANI_FRAME_TYPE_SPRITE
+
+    @property
+    def name(self):
+        """
+        Name of the sprite frame (sprite frames only).
+        """
+        return self.data.decode(errors="replace").split("\0")[0] if self.is_sprite else ""
+
+    @property
+    def values(self):
+        """
+        The same 8 bytes as `data`, as two int32 values (non-sprite frames).
+        """
+        return struct.unpack("<2i", self.data)
 
 
 class SpriteFile(MMFile):
     signature = "SPR\0"
     header_size = 24
 
+    def __init__(self, source, lazy: bool = False):
+        """
+        With `lazy` set, `frames` is a `FrameTable` which only parses frames as they are accessed; the source
+        (file handle or buffer) must then remain open for as long as frames are read.
+        """
+        self.lazy = lazy
+        super().__init__(source)
+
     @property
     def data_offset(self):
         return self.header_size + (self.palette_count * PALETTE_SIZE * 3) + (self.frame_count * 4)
 
+    @property
+    def first_frame_offset(self):
+        if self.version == 2:
+            return self.data_offset - 4
+
+        return self.data_offset
+
     def parse_header(self, fh: BinaryIO):
         fh.seek(8)
 
@@ -27,29 +104,132 @@ class SpriteFile(MMFile):
         self.frame_count = uint32(fh)
         self.palette_count = uint32(fh)
 
-    def parse_data(self, fh: BinaryIO):
-        self.frames = []
-        self.palettes = []
+    def unpack_header(self, buffer: memoryview):
+        self.version, self.frame_count, self.palette_count = struct.unpack_from("<3I", buffer, 8)
 
+    def parse_data(self, fh: BinaryIO):
         fh.seek(self.header_size)
 
         if self.palette_count == 0:
-            self.palettes.append(GreyscalePalette())
+            self.palettes = [GREYSCALE_PALETTE]
         else:
-            for x in range(self.palette_count):
-                self.palettes.append(Palette.from_buffer(fh))
+            self.palettes = [Palette.from_buffer(fh) for x in range(self.palette_count)]
 
-        fh.seek(self.data_offset)
+        self.load_frames(fh)
 
-        if self.version == 2:
-            fh.seek(-4, os.SEEK_CUR)
+    def unpack_data(self, buffer: memoryview):
+        if self.palette_count == 0:
+            self.palettes = [GREYSCALE_PALETTE]
+        else:
+            self.palettes = [
+                Palette.unpack_from(buffer, self.header_size + x * PALETTE_SIZE * 3)
+                for x in range(self.palette_count)
+            ]
+
+        self.load_frames(buffer)
+
+    def load_frames(self, source):
+        self.frames = FrameTable(source, self.first_frame_offset, self.frame_count, self.version)
+
+        if not self.lazy:
+            self.frames = list(self.frames)
+
+    def frame_headers(self):
+        """
+        Every frame's dimensions, centre, name and palette index (as `FrameHeader`s). Lazy sprites only read each
+        frame's fixed header, skipping the row tables, which is much quicker than parsing `frames`.
+        """
+        if isinstance(self.frames, FrameTable):
+            return self.frames.headers()
+
+        return [FrameHeader(*(getattr(frame, field) for field in FrameHeader._fields)) for frame in self.frames]
+
+    @classmethod
+    def read_stream_header(cls, stream: BinaryIO, header: bytes = b""):
+        """
+        Reads the header and palettes from a forward-only stream (e.g. a pipe), stopping at the first frame.
+        `header` is any part of the header already read from the stream. Returns a sprite without frames;
+        pass the same stream to `stream_frames` to read them.
+        """
+        try:
+            header += read_exactly(stream, cls.header_size - len(header))
+        except EOFError as e:
+            raise InvalidFileSize(str(e)) from e
 
-        for x in range(self.frame_count):
-            frame = Frame.from_buffer(fh, self.version)
-            self.frames.append(frame)
+        sig, reported_size = FILE_HEADER.unpack_from(header)
+        sig = sig.decode(errors="replace")
 
-            if (x + 1) < self.frame_count:
-                fh.seek(frame.offset + frame.size)
+        if sig != cls.signature:
+            raise InvalidSignature(f'expected "{cls.signature}" but got "{sig}"')
+
+        sprite = cls.__new__(cls)
+        sprite.lazy = True
+        sprite.buffer = None
+        sprite.frames = []
+        sprite.reported_size = reported_size
+        sprite.unpack_header(memoryview(header))
+
+        if sprite.first_frame_offset > reported_size:
+            raise InvalidFileSize(f"expected at least {sprite.first_frame_offset} but got {reported_size}")
+
+        try:
+            if sprite.palette_count == 0:
+                sprite.palettes = [GREYSCALE_PALETTE]
+            else:
+                sprite.palettes = [
+                    Palette.from_rgb(read_exactly(stream, PALETTE_SIZE * 3))
+                    for x in range(sprite.palette_count)
+                ]
+
+            # Frame offsets (and a font's tables) aren't needed, as frames are read in order
+            skip(stream, sprite.first_frame_offset - cls.header_size - sprite.palette_count * PALETTE_SIZE * 3)
+        except EOFError as e:
+            raise InvalidFileSize(str(e)) from e
+
+        return sprite
+
+    def stream_frames(self, stream: BinaryIO, engine: str = "python"):
+        """
+        Yields (frame, pixels) tuples, reading each frame from the stream in turn and only keeping the current
+        frame in memory. `pixels` are as returned by `get_pixel_data`, or `get_pixel_array` for the numpy engine,
+        and None for frames without valid dimensions. Frame offsets are from the start of the file.
+        """
+        position = self.first_frame_offset
+
+        try:
+            for x in range(self.frame_count):
+                size_bytes = read_exactly(stream, 4)
+                size = struct.unpack("<I", size_bytes)[0]
+
+                if size < FRAME_HEADER.size or position + size > self.reported_size:
+                    raise InvalidFileSize(f"frame {x} ({size} bytes at {position}) overruns the file")
+
+                data = memoryview(size_bytes + read_exactly(stream, size - 4))
+                frame = Frame.unpack_from(data, 0, self.version)
+                pixels = None
+
+                if frame.has_valid_dimensions:
+                    if engine == "numpy":
+                        pixels = frame.get_pixel_array(data, self.palettes)
+                    else:
+                        pixels = frame.get_pixel_data(data, self.palettes)
+
+                frame.offset = position
+                position += size
+
+                yield frame, pixels
+
+            # Trailing data is consumed so that the stream ends up at the start of whatever follows the file
+            skip(stream, self.reported_size - position)
+        except EOFError as e:
+            raise InvalidFileSize(f"expected {self.reported_size} bytes: {e}") from e
+
+    @classmethod
+    def iter_frames(cls, stream: BinaryIO, engine: str = "python"):
+        """
+        Single pass, forward-only equivalent of reading a sprite and decoding every frame; see `stream_frames`.
+        """
+        yield from cls.read_stream_header(stream).stream_frames(stream, engine)
 
 
 class FontFile(SpriteFile):
@@ -67,3 +247,284 @@ class FontFile(SpriteFile):
         self.frame_count = uint32(fh)
         self.unknown_values = [uint32(fh) for x in range(4)]
         self.palette_count = uint32(fh)
+
+    def unpack_header(self, buffer: memoryview):
+        self.version, self.frame_count, *self.unknown_values, self.palette_count = struct.unpack_from("<7I", buffer, 8)
+
+
+def read_sprite_stream(stream: BinaryIO):
+    """
+    Reads a sprite or font header from a forward-only stream, choosing the class by its signature.
+    """
+    try:
+        header = read_exactly(stream, 4)
+    except EOFError as e:
+        raise InvalidFileSize(str(e)) from e
+
+    for cls in (SpriteFile, FontFile):
+        if header == cls.signature.encode():
+            return cls.read_stream_header(stream, header)
+
+    raise InvalidSignature(f'expected a sprite or font but got "{header.decode(errors="replace")}"')
+
+
+class MapFile(MMFile):
+    """
+    A decrypted .map segment (see `mm_decrypt`). Tiles are exposed as a NumPy structured array of shape
+    (size_z, size_y, size_x), which is a zero-copy view when the map is read from a path or buffer.
+    """
+    header_size = MAP_HEADER.size
+
+    def __init__(self, source):
+        if np is None:
+            raise ImportError("MapFile requires numpy")
+
+        super().__init__(source)
+
+    @classmethod
+    def from_encrypted(cls, source):
+        """
+        Reads a map straight from its encrypted file (path or bytes).
+        """
+        from mm_decrypt import unpack
+
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, mode="rb") as fh:
+                source = fh.read()
+
+        return cls(unpack(source))
+
+    def verify_header(self, header: bytes, actual_size: int):
+        # Maps have no signature; their size follows from their dimensions
+        if len(header) < self.header_size:
+            raise InvalidFileSize(f"expected at least {self.header_size} but got {actual_size}")
+
+        size_x, size_y, size_z = struct.unpack_from("<3I", header, 4)
+        expected_size = self.header_size + size_x * size_y * size_z * MAP_TILE_DTYPE.itemsize
+
+        if expected_size != actual_size:
+            raise InvalidFileSize(f"expected {expected_size} but got {actual_size}")
+
+    def parse_header(self, fh: BinaryIO):
+        fh.seek(0)
+        self.unpack_header(fh.read(self.header_size))
+
+    def unpack_header(self, buffer: memoryview):
+        values = MAP_HEADER.unpack_from(buffer)
+
+        (
+            self.version,
+            self.size_x,
+            self.size_y,
+            self.size_z,
+            self.area,
+            self.volume,
+            self.segments_x,
+            self.segments_y,
+        ) = values[:8]
+
+        # [side][edge], e.g. edges[0][1] is Side0_Edge1; -1 where there is no segment
+        self.edges = [list(values[x:x + 2]) for x in range(8, 16, 2)]
+        self.unknown_values = list(values[16:])
+
+    def parse_data(self, fh: BinaryIO):
+        fh.seek(0)
+        self.unpack_data(fh.read())
+
+    def unpack_data(self, buffer: memoryview):
+        tile_count = self.size_x * self.size_y * self.size_z
+        tiles = np.frombuffer(buffer, dtype=MAP_TILE_DTYPE, count=tile_count, offset=self.header_size)
+
+        self.tiles = tiles.reshape(self.size_z, self.size_y, self.size_x)
+
+    @property
+    def terrain_indices(self):
+        return self.tiles["terrain_index"]
+
+    def layer(self, z: int):
+        return self.tiles[z]
+
+    def find_terrain(self, terrain_index: int):
+        """
+        Returns the (z, y, x) coordinates of every tile using `terrain_index`, as an (n, 3) array.
+        """
+        return np.argwhere(self.terrain_indices == terrain_index)
+
+    def terrain_counts(self):
+        """
+        Number of tiles using each terrain index (negative indices are ignored).
+        """
+        indices = self.terrain_indices.ravel()
+        return np.bincount(indices[indices >= 0])
+
+    def walkable_mask(self):
+        """
+        Boolean (size_z, size_y, size_x) mask of tiles with `unknown_5` set, which appears to flag walkable tiles.
+        """
+        return self.tiles["unknown_5"] != 0
+
+
+class TerrainTypeFile(MMFile):
+    """
+    Terrain.ttd: `tile_count` fixed size terrain type records, in the same order as the frames of Terrain.spr.
+
+    Records are decoded in bulk into a (tile_count, 89) int32 array with one column per DWORD field, which is a
+    zero-copy view when read from a path or buffer. The record layout is undocumented, so fields are addressed by
+    index (DWORD offset into the record), and which fields refer to other tiles is inferred from the data (see
+    `find_reference_fields`). Reverse indexes of those fields, and of `burnt_field` if given, are built on load.
+    """
+    signature = "TTD\0"
+    header_size = 16
+
+    def __init__(self, source, burnt_field: int = None):
+        """
+        `burnt_field` is the field holding the tile each terrain switches to when burnt; its offset isn't known yet,
+        so it has to be given for `burnt_tile`/`burnt_from` to be available.
+        """
+        if np is None:
+            raise ImportError("TerrainTypeFile requires numpy")
+
+        self.indexes = {}
+        self.burnt_field = burnt_field
+        super().__init__(source)
+
+        self.reference_fields = self.find_reference_fields()
+
+        for field in self.reference_fields:
+            self.build_index(field)
+
+        if burnt_field is not None:
+            self.build_index(burnt_field)
+
+    def parse_header(self, fh: BinaryIO):
+        fh.seek(8)
+
+        self.version = uint32(fh)
+        self.tile_count = uint32(fh)
+
+    def unpack_header(self, buffer: memoryview):
+        self.version, self.tile_count = struct.unpack_from("<2I", buffer, 8)
+
+    def parse_data(self, fh: BinaryIO):
+        fh.seek(0)
+        self.unpack_data(fh.read())
+
+    def unpack_data(self, buffer: memoryview):
+        fields = np.frombuffer(buffer, dtype="<i4", count=self.tile_count * TERRAIN_TYPE_FIELDS, offset=self.header_size)
+        self.fields = fields.reshape(self.tile_count, TERRAIN_TYPE_FIELDS)
+
+    def column(self, field: int):
+        """
+        One field of every record, as a view; `column(field)[tile]` is an O(1) lookup.
+        """
+        return self.fields[:, field]
+
+    def record(self, tile: int):
+        return self.fields[tile]
+
+    def find_reference_fields(self):
+        """
+        Fields which look like references to other tiles: every value is -1 (none) or a valid tile index, and there
+        are more than two distinct values (which rules out flags). This is a guess from the data, not a documented
+        layout.
+        """
+        if self.tile_count == 0:
+            return []
+
+        in_range = ((self.fields >= -1) & (self.fields < self.tile_count)).all(axis=0)
+
+        return [
+            int(field) for field in np.flatnonzero(in_range)
+            if np.unique(self.fields[:, field]).size > 2
+        ]
+
+    def build_index(self, field: int):
+        """
+        Precomputes a reverse index of `field`, mapping each value to the tiles which hold it.
+        """
+        if field not in self.indexes:
+            values = self.column(field)
+            order = np.argsort(values, kind="stable")
+            sorted_values = values[order]
+            keys, starts = np.unique(sorted_values, return_index=True)
+            ends = np.append(starts[1:], len(order))
+
+            self.indexes[field] = (order, dict(zip(keys.tolist(), zip(starts.tolist(), ends.tolist()))))
+
+        return self.indexes[field]
+
+    def find(self, field: int, value: int):
+        """
+        Returns the tiles whose `field` equals `value`, e.g. every tile which refers to another tile by index.
+        """
+        order, ranges = self.build_index(field)
+        start, end = ranges.get(value, (0, 0))
+
+        return order[start:end]
+
+    def burnt_tile(self, tile: int):
+        """
+        The tile `tile` switches to when burnt (-1 for none). Requires `burnt_field`.
+        """
+        if self.burnt_field is None:
+            raise ValueError("burnt_field wasn't given")
+
+        return int(self.fields[tile, self.burnt_field])
+
+    def burnt_from(self, tile: int):
+        """
+        Every tile which switches to `tile` when burnt. Requires `burnt_field`.
+        """
+        if self.burnt_field is None:
+            raise ValueError("burnt_field wasn't given")
+
+        return self.find(self.burnt_field, tile)
+
+
+class AniFile(MMFile):
+    """
+    Animation table (.ani). `frames` holds every frame record, decoded in one pass; `animations` are slices of it,
+    one per animation group (including the last).
+    """
+    signature = "ANI\0"
+    header_size = ANI_HEADER.size
+
+    @property
+    def frames_offset(self):
+        return self.header_size + self.animation_count * 4
+
+    def parse_header(self, fh: BinaryIO):
+        fh.seek(0)
+        self.unpack_header(fh.read(self.header_size))
+
+    def unpack_header(self, buffer: memoryview):
+        values = ANI_HEADER.unpack_from(buffer)
+        _, _, self.frame_count, self.version, self.unknown, self.animation_count, sprite_file = values
+
+        self.sprite_file = sprite_file.decode(errors="replace").split("\0")[0]
+
+    def parse_data(self, fh: BinaryIO):
+        fh.seek(0)
+        self.unpack_data(fh.read())
+
+    def unpack_data(self, buffer: memoryview):
+        self.animation_offsets = list(struct.unpack_from(f"<{self.animation_count}I", buffer, self.header_size))
+
+        frame_count = min(self.frame_count, (len(buffer) - self.frames_offset) // ANI_FRAME.size)
+        frames = buffer[self.frames_offset:self.frames_offset + frame_count * ANI_FRAME.size]
+
+        self.frames = list(map(AniFrame._make, ANI_FRAME.iter_unpack(frames)))
+
+    def animation_range(self, index: int):
+        start = self.animation_offsets[index]
+        end = self.animation_offsets[index + 1] if index + 1 < self.animation_count else len(self.frames)
+
+        return start, max(start, end)
+
+    def animation(self, index: int):
+        start, end = self.animation_range(index)
+        return self.frames[start:end]
+
+    @property
+    def animations(self):
+        return [self.animation(x) for x in range(self.animation_count)]
@@ -0,0 +1,241 @@
+"""
+Encodes frames and writes SPR and SFT files which round-trip through `SpriteFile` and `FontFile`.
+
+    writer = SpriteWriter.from_sprite(SpriteFile("Terrain.spr"))
+    writer.frames[12] = encode_rgba(pixels, name="TERR0012", palette=writer.palettes[0], version=writer.version)
+    writer.save("Terrain.spr")
+
+Frames are encoded as in the game's own files: each row is a series of alternating transparent and colour
+runs (starting with a transparent run) which always covers the frame's full width. Runs longer than 255 pixels
+are split by zero length runs. The two unknown offsets in version 3+ frame headers are written as zero; frames
+copied from an existing sprite are kept byte for byte, unknown data included.
+"""
+
+import struct
+
+from pathlib import Path
+
+import numpy as np
+
+from base_classes import FRAME_HEADER, GREYSCALE_PALETTE, PALETTE_SIZE, Palette, frame_header_size
+
+
+MAX_RUN = 255
+
+
+class UnknownColourException(Exception):
+    pass
+
+
+def encode_runs(opaque):
+    """
+    Returns the run lengths of every row of a (height, width) bool mask, concatenated, and the number of runs
+    in each row.
+    """
+    height, width = opaque.shape
+
+    # A run starts at the beginning of every row (always transparent, possibly empty) and wherever the mask changes
+    change = np.empty((height, width), dtype=bool)
+    change[:, :1] = opaque[:, :1]
+    change[:, 1:] = opaque[:, 1:] != opaque[:, :-1]
+    change_y, change_x = np.nonzero(change)
+
+    run_y = np.concatenate((np.arange(height), change_y))
+    run_x = np.concatenate((np.zeros(height, dtype=np.int64), change_x))
+    order = np.lexsort((np.arange(run_y.size), run_x, run_y))
+    run_y = run_y[order]
+    run_x = run_x[order]
+
+    # Each run ends where the next one in the same row starts, or at the end of the row
+    run_end = np.full(run_x.size, width, dtype=np.int64)
+    same_row = run_y[1:] == run_y[:-1]
+    run_end[:-1][same_row] = run_x[1:][same_row]
+    lengths = run_end - run_x
+
+    # Long runs become 255, 0, 255, 0, ... remainder; an odd number of entries keeps the runs alternating
+    pieces = np.maximum(1, -(-lengths // MAX_RUN))
+    counts = pieces * 2 - 1
+    first = np.cumsum(counts) - counts
+    position = np.arange(int(counts.sum())) - np.repeat(first, counts)
+    remaining = np.repeat(lengths, counts) - (position // 2) * MAX_RUN
+    deltas = np.where(position & 1 == 0, np.minimum(remaining, MAX_RUN), 0).astype(np.uint8)
+
+    return deltas, np.bincount(run_y, weights=counts, minlength=height).astype(np.int64)
+
+
+def encode_indexed(indices, opaque=None, transparent_index: int = None, name: str = "", centre_x: int = 0, centre_y: int = 0, palette_index: int = 0, version: int = 4):
+    """
+    Encodes a (height, width) array of palette indices as a frame. Transparent pixels are given either as a
+    bool mask of opaque pixels, or as the index used for them (as returned by `Frame.get_index_array`).
+    """
+    indices = np.asarray(indices, dtype=np.uint8)
+
+    if opaque is None:
+        if transparent_index is None:
+            opaque = np.ones(indices.shape, dtype=bool)
+        else:
+            opaque = indices != transparent_index
+
+    height, width = indices.shape
+    deltas, row_runs = encode_runs(np.asarray(opaque, dtype=bool))
+    pixels = indices[opaque]
+    row_pixels = np.count_nonzero(opaque, axis=1)
+
+    # Row table, then every row's deltas, then every row's pixels; offsets are from the start of the frame
+    table_end = frame_header_size(version) + height * 8
+    rows = np.empty((height, 2), dtype="<u4")
+    rows[:, 0] = table_end + np.cumsum(row_runs) - row_runs
+    rows[:, 1] = table_end + deltas.size + np.cumsum(row_pixels) - row_pixels
+    size = table_end + deltas.size + pixels.size
+
+    header = FRAME_HEADER.pack(size, width, height, centre_x, centre_y, name.encode()[:8], palette_index)
+
+    return b"".join((
+        header,
+        bytes(frame_header_size(version) - FRAME_HEADER.size),
+        rows.tobytes(),
+        deltas.tobytes(),
+        pixels.tobytes(),
+    ))
+
+
+def rgba_array(pixels):
+    """
+    Accepts RGBA pixels as returned by `Frame.get_pixel_array` or `Frame.get_pixel_data`.
+    """
+    if isinstance(pixels, list):
+        return np.frombuffer(b"".join(pixels), dtype=np.uint8).reshape(len(pixels), -1, 4)
+
+    pixels = np.asarray(pixels, dtype=np.uint8)
+
+    return pixels.reshape(pixels.shape[0], -1, 4)
+
+
+def palette_indices(rgb, palette: Palette):
+    """
+    Maps an (..., 3) array of colours to their first index in `palette`.
+    """
+    keys = rgb.astype(np.uint32) @ np.array([1 << 16, 1 << 8, 1], dtype=np.uint32)
+    palette_keys = palette.array[:, :3].astype(np.uint32) @ np.array([1 << 16, 1 << 8, 1], dtype=np.uint32)
+    unique_keys, first = np.unique(palette_keys, return_index=True)
+
+    position = np.minimum(np.searchsorted(unique_keys, keys), unique_keys.size - 1)
+    missing = unique_keys[position] != keys
+
+    if missing.any():
+        colour = tuple(int(x) for x in rgb[missing][0])
+        raise UnknownColourException(f"{np.count_nonzero(missing)} pixels aren't in the palette (e.g. {colour})")
+
+    return first[position].astype(np.uint8)
+
+
+def encode_rgba(pixels, name: str = "", centre_x: int = 0, centre_y: int = 0, palette: Palette = GREYSCALE_PALETTE, palette_index: int = 0, version: int = 4):
+    """
+    Encodes RGBA pixels as a frame; fully transparent pixels (alpha 0) become transparent runs, and every other
+    pixel must match a colour in `palette`.
+    """
+    pixels = rgba_array(pixels)
+    opaque = pixels[:, :, 3] != 0
+    indices = np.zeros(opaque.shape, dtype=np.uint8)
+    indices[opaque] = palette_indices(pixels[opaque][:, :3], palette)
+
+    return encode_indexed(indices, opaque, None, name, centre_x, centre_y, palette_index, version)
+
+
+class SpriteWriter:
+    """
+    Assembles encoded frames into a sprite file. `frames` holds each frame's bytes, and `palettes` may be empty
+    for a palette-less (greyscale) sprite.
+    """
+
+    def __init__(self, version: int = 4, palettes: list = None, font: bool = False, unknown: int = 0, unknown_values: list = None, font_tables: bytes = None):
+        self.version = version
+        self.palettes = list(palettes or [])
+        self.font = font
+        self.unknown = unknown
+        self.unknown_values = list(unknown_values or [0, 0, 0, 0])
+        self.font_tables = font_tables
+        self.frames = []
+
+    @classmethod
+    def from_sprite(cls, sprite):
+        """
+        Copies a sprite's header, palettes and frames (unchanged, as raw bytes) so that frames can be replaced.
+        """
+        font = hasattr(sprite, "unknown_values")
+        source = sprite.buffer
+
+        if source is None:
+            raise ValueError("the sprite must have been read from a path or buffer")
+
+        writer = cls(
+            version=sprite.version,
+            palettes=sprite.palettes if sprite.palette_count else [],
+            font=font,
+            unknown=struct.unpack_from("<I", source, sprite.header_size - 4)[0],
+            unknown_values=sprite.unknown_values if font else None,
+        )
+
+        if font:
+            tables_offset = sprite.header_size + sprite.palette_count * PALETTE_SIZE * 3 + sprite.frame_count * 4
+            writer.font_tables = bytes(source[tables_offset:sprite.data_offset])
+
+        writer.frames = [bytes(frame.read_data(source)) for frame in sprite.frames]
+
+        return writer
+
+    def add_frame(self, data: bytes):
+        self.frames.append(data)
+
+    def add_indexed(self, indices, **kwargs):
+        self.frames.append(encode_indexed(indices, version=self.version, **kwargs))
+
+    def add_rgba(self, pixels, palette_index: int = 0, **kwargs):
+        palette = self.get_palette(palette_index)
+        self.frames.append(encode_rgba(pixels, palette=palette, palette_index=palette_index, version=self.version, **kwargs))
+
+    def get_palette(self, index: int):
+        """
+        The palette a frame with this palette index is decoded with, as in `Frame.get_palette`.
+        """
+        if not self.palettes:
+            return GREYSCALE_PALETTE
+
+        if index < 0 or index >= len(self.palettes):
+            return self.palettes[0]
+
+        return self.palettes[index]
+
+    def to_bytes(self):
+        frame_count = len(self.frames)
+        palettes = b"".join(palette.array[:, :3].tobytes() for palette in self.palettes)
+
+        # Offsets are relative to the first frame; version 2 sprites omit the first entry
+        sizes = np.array([len(frame) for frame in self.frames], dtype=np.int64)
+        offsets = (np.cumsum(sizes) - sizes).astype("<u4")
+
+        if self.version == 2:
+            offsets = offsets[1:]
+
+        if self.font:
+            tables_size = sum(self.unknown_values) * frame_count * 4
+            font_tables = self.font_tables if self.font_tables is not None else bytes(tables_size)
+
+            if len(font_tables) != tables_size:
+                raise ValueError(f"expected {tables_size} bytes of font tables but got {len(font_tables)}")
+
+            header = struct.pack("<4s9I", b"SFT\0", 0, self.version, frame_count, *self.unknown_values, len(self.palettes), self.unknown)
+        else:
+            font_tables = b""
+            header = struct.pack("<4s5I", b"SPR\0", 0, self.version, frame_count, len(self.palettes), self.unknown)
+
+        data = bytearray(b"".join((header, palettes, offsets.tobytes(), font_tables, *self.frames)))
+        struct.pack_into("<I", data, 4, len(data))
+
+        return bytes(data)
+
+    def save(self, path):
+        data = self.to_bytes()
+        Path(path).write_bytes(data)
+
+        return len(data)
@@ -1,3 +1,5 @@
+import mmap
+import os
 import struct
 
 from typing import BinaryIO
@@ -13,3 +15,46 @@ def uint8(fh: BinaryIO):
 
 def uint32(fh: BinaryIO):
     return struct.unpack("<I", fh.read(4))[0]
+
+
+def read_exactly(stream: BinaryIO, size: int):
+    """
+    Reads exactly `size` bytes from a stream which may return short reads (e.g. a pipe).
+    """
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+
+        if not chunk:
+            raise EOFError(f"expected {size} bytes but got {len(data)}")
+
+        data += chunk
+
+    return bytes(data)
+
+
+def skip(stream: BinaryIO, size: int, chunk_size: int = 65536):
+    """
+    Discards `size` bytes from a forward-only stream.
+    """
+    while size > 0:
+        size -= len(read_exactly(stream, min(size, chunk_size)))
+
+
+def as_buffer(source):
+    """
+    Returns a read-only memoryview for paths and bytes-like sources, or None for file handles.
+    Paths are memory-mapped so that several processes can share the same pages.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, mode="rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return memoryview(b"")
+
+            return memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        return memoryview(source).cast("B").toreadonly()
+
+    return None